@@ -0,0 +1,210 @@
+#!/usr/bin/python2.6
+# Copyright 2011 Google Inc. All Rights Reserved.
+# Author: Liz Fong (lizf@google.com/lizfong@mit.edu)
+
+"""Cracks many Bitdael keys in one batch.
+
+Keys are cracked concurrently by a pool of workers, each running the usual
+BitDiddleModule phases for one key at a time. Remote keys spend their time
+waiting on the keymaster, so they are cracked by threads and their queries
+interleave on the wire; local keys spend it computing, so by default they
+are cracked by processes. Key-independent work is done once for the whole
+batch: the byte permutation index that Map gathers from is loaded before the
+pool starts, so forked workers share its pages instead of each loading it.
+
+Usage:
+  bitdiddle_batch.py [--corpus=keys.jsonl | --count=N --seed=S --rounds=R]
+      [--workers=N] [--threads] [--enumerate]
+"""
+
+import multiprocessing
+import multiprocessing.pool
+import optparse
+import os
+import sys
+import time
+
+import bitdiddle_lib
+
+
+class BitDiddleBatchResult(object):
+  """The outcome of cracking one key in a batch.
+
+  Attributes:
+    key_id: The keymaster's KeyId.
+    passed: Whether the recovered key passed Check.
+    oracle_calls: Keymaster queries made for this key.
+    seconds: Wall time spent on this key.
+    error: The message of the exception that stopped the crack, or None.
+    p: The recovered p, or None.
+    s: The recovered S, or None.
+  """
+
+  def __init__(self, key_id):
+    self.key_id = key_id
+    self.passed = False
+    self.oracle_calls = 0
+    self.seconds = 0.0
+    self.error = None
+    self.p = None
+    self.s = None
+
+  def __str__(self):
+    if self.error is not None:
+      status = "error: %s" % self.error
+    elif self.passed:
+      status = "cracked"
+    else:
+      status = "failed check"
+    return "%s %s (%s oracle calls, %.2fs)" % (
+        self.key_id, status, self.oracle_calls, self.seconds)
+
+
+class BitDiddleBatchReport(object):
+  """Per-key results and aggregate throughput of a batch.
+
+  Attributes:
+    results: A BitDiddleBatchResult per key, in the order keys were given.
+    seconds: Wall time for the whole batch.
+  """
+
+  def __init__(self, results, seconds):
+    self.results = results
+    self.seconds = seconds
+
+  def Cracked(self):
+    """Returns how many keys were cracked."""
+    return len([result for result in self.results if result.passed])
+
+  def KeysPerMinute(self):
+    """Returns cracked keys per minute of batch wall time."""
+    if not self.seconds:
+      return 0.0
+    return self.Cracked() * 60.0 / self.seconds
+
+  def OracleCalls(self):
+    """Returns the keymaster queries made across the batch."""
+    return sum([result.oracle_calls for result in self.results])
+
+  def __str__(self):
+    return ("Cracked %s of %s keys in %.2fs (%.1f keys/minute, "
+            "%s oracle calls)." % (self.Cracked(), len(self.results),
+                                   self.seconds, self.KeysPerMinute(),
+                                   self.OracleCalls()))
+
+
+def _CrackKey(task):
+  """Cracks one key in a batch worker.
+
+  Args:
+    task: A tuple (keymaster, options) of the key to crack and keyword
+        arguments for BitDiddleModule.
+
+  Returns:
+    A BitDiddleBatchResult.
+  """
+  keymaster, options = task
+  result = BitDiddleBatchResult(keymaster.KeyId())
+  options = dict(options)
+  # Checkpoints are per key, so give every key its own directory.
+  if options.get("checkpoint_dir") is not None:
+    options["checkpoint_dir"] = os.path.join(options["checkpoint_dir"],
+                                             result.key_id)
+  start = time.time()
+  try:
+    module = bitdiddle_lib.BitDiddleModule(keymaster=keymaster, **options)
+    result.passed = module.RunSerially().passed
+    result.p = list(module.p_guess)
+    result.s = list(module.s_guess)
+  except Exception, e:  # pylint: disable-msg=W0703
+    # One key failing should not stop the rest of the batch.
+    result.error = str(e) or e.__class__.__name__
+  result.seconds = time.time() - start
+  result.oracle_calls = keymaster.oracle_calls
+  return result
+
+
+class BitDiddleBatchCracker(object):
+  """Cracks a batch of keymasters across a worker pool."""
+
+  def __init__(self, workers=None, use_processes=True, **options):
+    """Configures a batch.
+
+    Args:
+      workers: Keys cracked at once; defaults to the CPU count.
+      use_processes: Whether workers are processes rather than threads.
+          Processes suit local keys; remote keys, which are not picklable and
+          mostly wait on the network, need threads.
+      **options: Keyword arguments for each key's BitDiddleModule. By default
+          nothing is written to disk; a checkpoint_dir given here gets one
+          subdirectory per key.
+    """
+    self.workers = workers or multiprocessing.cpu_count()
+    self.use_processes = use_processes
+    self.options = {"output_dir": None, "checkpoint_dir": None}
+    self.options.update(options)
+
+  def Crack(self, keymasters):
+    """Cracks every keymaster.
+
+    Args:
+      keymasters: The BitDiddleKeyMasters to crack.
+
+    Returns:
+      A BitDiddleBatchReport.
+    """
+    # Load the shared precomputation before any worker exists.
+    if not self.options.get("structural", True):
+      bitdiddle_lib.BitDiddlePermutationIndex.Shared()
+
+    start = time.time()
+    tasks = [(keymaster, self.options) for keymaster in keymasters]
+    if self.use_processes:
+      pool = multiprocessing.Pool(self.workers)
+    else:
+      pool = multiprocessing.pool.ThreadPool(self.workers)
+    try:
+      results = []
+      for result in pool.imap(_CrackKey, tasks):
+        print result
+        results.append(result)
+    finally:
+      pool.close()
+      pool.join()
+    report = BitDiddleBatchReport(results, time.time() - start)
+    print report
+    return report
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage=__doc__.split("Usage:")[1])
+  parser.add_option("--corpus", help="A key corpus saved by "
+                    "BitDiddleKeyCorpus.Save.")
+  parser.add_option("--count", type="int", default=16,
+                    help="Keys to generate when no corpus is given.")
+  parser.add_option("--seed", type="int", default=0,
+                    help="The corpus seed when no corpus is given.")
+  parser.add_option("--rounds", type="int", default=3)
+  parser.add_option("--workers", type="int")
+  parser.add_option("--threads", action="store_true", default=False,
+                    help="Use worker threads instead of processes.")
+  parser.add_option("--enumerate", action="store_true", default=False,
+                    help="Enumerate permutations with Map and Reduce "
+                    "instead of using Solve.")
+  options, _ = parser.parse_args(argv[1:])
+
+  if options.corpus:
+    corpus = bitdiddle_lib.BitDiddleKeyCorpus.Load(options.corpus)
+  else:
+    corpus = bitdiddle_lib.BitDiddleKeyCorpus.Generate(
+        options.count, options.seed, options.rounds)
+  cracker = BitDiddleBatchCracker(options.workers, not options.threads,
+                                  structural=not options.enumerate)
+  report = cracker.Crack(corpus.KeyMasters())
+  if report.Cracked() != len(report.results):
+    return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,305 @@
+#!/usr/bin/python2.6
+# Copyright 2011 Google Inc. All Rights Reserved.
+# Author: Liz Fong (lizf@google.com/lizfong@mit.edu)
+
+"""Benchmarks the Bitdael primitives and the full crack.
+
+Each benchmark runs in its own worker process from a fixed random seed, so
+results are reproducible and the peak memory reported is that benchmark's
+alone. Results are printed, optionally saved as JSON, and optionally compared
+against a saved baseline, in which case any benchmark whose throughput fell
+by more than the tolerance is flagged and the exit status is non-zero.
+
+Usage:
+  bitdiddle_benchmark.py [--output=results.json] [--baseline=baseline.json]
+      [--tolerance=0.2] [--seed=3] [--only=name,...]
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import bitdiddle_lib
+
+
+def _LocalModule(seed, structural=True):
+  """Returns a BitDiddleModule cracking a seeded local key, without files."""
+  return bitdiddle_lib.BitDiddleModule(
+      key_seed=seed, seed=seed, output_dir=None, structural=structural,
+      checkpoint_dir=None)
+
+
+def _Block(bits):
+  return random.getrandbits(bits)
+
+
+def SetUpPermute(unused_seed):
+  p = bitdiddle_lib.BitDiddlePermutation(random.sample(range(0, 64), 64))
+  halves = [_Block(64) for _ in range(0, 10000)]
+
+  def Run():
+    for half in halves:
+      bitdiddle_lib.BitDiddleUtil.Permute(half, p)
+  return Run, len(halves)
+
+
+def SetUpUnpermute(unused_seed):
+  p = bitdiddle_lib.BitDiddlePermutation(random.sample(range(0, 64), 64))
+  halves = [_Block(64) for _ in range(0, 10000)]
+
+  def Run():
+    for half in halves:
+      bitdiddle_lib.BitDiddleUtil.Unpermute(half, p)
+  return Run, len(halves)
+
+
+def SetUpSubstitute(unused_seed):
+  s = [random.randint(0, 255) for _ in range(0, 256)]
+  halves = [_Block(64) for _ in range(0, 10000)]
+
+  def Run():
+    for half in halves:
+      bitdiddle_lib.BitDiddleUtil.Substitute(half, s)
+  return Run, len(halves)
+
+
+def SetUpRound(unused_seed):
+  p = bitdiddle_lib.BitDiddlePermutation(random.sample(range(0, 64), 64))
+  s = [random.randint(0, 255) for _ in range(0, 256)]
+  blocks = [_Block(128) for _ in range(0, 5000)]
+
+  def Run():
+    for block in blocks:
+      bitdiddle_lib.BitDiddleUtil.Round(block, p, s)
+  return Run, len(blocks)
+
+
+def SetUpEncryptLocally(unused_seed):
+  p = random.sample(range(0, 64), 64)
+  s = [random.randint(0, 255) for _ in range(0, 256)]
+  blocks = [_Block(128) for _ in range(0, 1000)]
+
+  def Run():
+    for block in blocks:
+      bitdiddle_lib.BitDiddleUtil.EncryptLocally(block, p, s, 3)
+  return Run, len(blocks)
+
+
+def SetUpGuessS(seed):
+  module = _LocalModule(seed)
+  p_initial = module.GuessPAdaptive()
+  offset = module.GuessOffset()
+
+  def Run():
+    # Forget the ciphertexts earlier calls fetched, so every call pays for
+    # its queries rather than finding them all cached.
+    module.keymaster.ciphercache.clear()
+    module.GuessS(p_initial, offset)
+  return Run, 1
+
+
+def SetUpMap(seed):
+  module = _LocalModule(seed)
+  p_initial, outputs = module.GuessOutputs()
+  # Build or load the permutation index outside the timed region.
+  bitdiddle_lib.BitDiddlePermutationIndex.Shared()
+
+  def Run():
+    for _ in bitdiddle_lib.BitDiddleModule.Map(outputs, 0):
+      pass
+  return Run, bitdiddle_lib.BitDiddleModule.PERMUTATION_COUNT
+
+
+def SetUpReduce(seed):
+  module = _LocalModule(seed)
+  p_initial, outputs = module.GuessOutputs()
+  s_key, source_list = bitdiddle_lib.BitDiddleModule.CandidatePipeline(
+      outputs).next()
+
+  def Run():
+    bitdiddle_lib.BitDiddleModule.Reduce(s_key, source_list, p_initial)
+  return Run, 1
+
+
+def SetUpRunSerially(seed):
+  def Run():
+    _LocalModule(seed).RunSerially()
+  return Run, 1
+
+
+def SetUpRunSeriallyEnumerating(seed):
+  bitdiddle_lib.BitDiddlePermutationIndex.Shared()
+
+  def Run():
+    _LocalModule(seed, structural=False).RunSerially()
+  return Run, 1
+
+
+# Benchmarks start from this seed unless told otherwise. Its local key is one
+# GuessP can recover, so the crack benchmarks run to completion.
+DEFAULT_SEED = 3
+
+# The shortest time to spend on one repetition of a benchmark.
+MIN_SECONDS = 0.1
+
+# (name, setup function, number of timed repetitions) for every benchmark.
+# Setup functions take the seed and return the function to time and how many
+# operations one call of it performs. The crack benchmarks use the key the
+# seed gives, so every repetition cracks the same key.
+BENCHMARKS = [
+    ("permute", SetUpPermute, 5),
+    ("unpermute", SetUpUnpermute, 5),
+    ("substitute", SetUpSubstitute, 5),
+    ("round", SetUpRound, 5),
+    ("encrypt_locally", SetUpEncryptLocally, 5),
+    ("guess_s", SetUpGuessS, 5),
+    ("map_one_byte", SetUpMap, 3),
+    ("reduce", SetUpReduce, 5),
+    ("run_serially", SetUpRunSerially, 3),
+    ("run_serially_enumerating", SetUpRunSeriallyEnumerating, 1),
+    ]
+
+
+def _RunBenchmark(task):
+  """Runs one benchmark in a worker process.
+
+  Args:
+    task: A tuple (name, seed).
+
+  Returns:
+    A dict of the benchmark's results.
+  """
+  name, seed = task
+  setup, repeat = [(setup, repeat) for benchmark, setup, repeat in BENCHMARKS
+                   if benchmark == name][0]
+  # The library reports results on stdout; keep them out of the way, and any
+  # files it writes in a scratch directory.
+  work_dir = tempfile.mkdtemp(prefix="bitdiddle-benchmark-")
+  cwd = os.getcwd()
+  stdout = sys.stdout
+  os.chdir(work_dir)
+  sys.stdout = open(os.devnull, "w")
+  try:
+    random.seed(seed)
+    function, ops = setup(seed)
+    # Time enough calls per repetition that quick benchmarks are measurable.
+    start = time.time()
+    function()
+    number = max(1, int(MIN_SECONDS / max(time.time() - start, 1e-6)))
+    times = []
+    for _ in range(0, repeat):
+      start = time.time()
+      for _ in range(0, number):
+        function()
+      times.append((time.time() - start) / number)
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+    os.chdir(cwd)
+    shutil.rmtree(work_dir, ignore_errors=True)
+  best = min(times)
+  return {"seconds": best,
+          "ops": ops,
+          "ops_per_sec": ops / best,
+          "repeat": repeat,
+          "number": number,
+          # ru_maxrss is in kilobytes on Linux.
+          "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def RunBenchmarks(names=None, seed=DEFAULT_SEED):
+  """Runs benchmarks, each in a fresh process.
+
+  Args:
+    names: The benchmarks to run; all of them if None.
+    seed: The random seed each benchmark starts from.
+
+  Returns:
+    A dict describing the run, with per-benchmark results under "results".
+  """
+  if names is None:
+    names = [name for name, _, _ in BENCHMARKS]
+  results = dict()
+  for name in names:
+    # A new single-use pool per benchmark isolates its peak memory.
+    pool = multiprocessing.Pool(1)
+    try:
+      results[name] = pool.apply(_RunBenchmark, ((name, seed),))
+    finally:
+      pool.close()
+      pool.join()
+    print "%-26s %12.1f ops/s %12.6f s %8d KB" % (
+        name, results[name]["ops_per_sec"], results[name]["seconds"],
+        results[name]["peak_rss_kb"])
+  return {"seed": seed,
+          "python": platform.python_version(),
+          "machine": platform.machine(),
+          "time": time.time(),
+          "results": results}
+
+
+def Compare(report, baseline, tolerance):
+  """Flags benchmarks that got slower than a baseline report.
+
+  Args:
+    report: A report returned by RunBenchmarks.
+    baseline: An earlier report to compare against.
+    tolerance: The fraction of baseline throughput that may be lost before a
+        benchmark counts as regressed.
+
+  Returns:
+    A list of the names of regressed benchmarks.
+  """
+  regressions = []
+  for name in sorted(report["results"]):
+    if name not in baseline["results"]:
+      continue
+    before = baseline["results"][name]["ops_per_sec"]
+    after = report["results"][name]["ops_per_sec"]
+    ratio = after / before
+    flag = ""
+    if ratio < 1 - tolerance:
+      flag = "  REGRESSION"
+      regressions.append(name)
+    print "%-26s %8.2fx baseline%s" % (name, ratio, flag)
+  return regressions
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage=__doc__.split("Usage:")[1])
+  parser.add_option("--output", help="Save the results as JSON to this file.")
+  parser.add_option("--baseline", help="Compare against this JSON report.")
+  parser.add_option("--tolerance", type="float", default=0.2,
+                    help="Throughput loss allowed before flagging a "
+                    "regression.")
+  parser.add_option("--seed", type="int", default=DEFAULT_SEED)
+  parser.add_option("--only", help="Comma-separated benchmarks to run.")
+  options, _ = parser.parse_args(argv[1:])
+
+  names = None
+  if options.only:
+    names = options.only.split(",")
+  report = RunBenchmarks(names, options.seed)
+  if options.output:
+    out = open(options.output, "w")
+    try:
+      json.dump(report, out, indent=2, sort_keys=True)
+    finally:
+      out.close()
+  if options.baseline:
+    baseline = json.load(open(options.baseline))
+    if Compare(report, baseline, options.tolerance):
+      return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,727 @@
+#!/usr/bin/python2.6
+# Copyright 2011 Google Inc. All Rights Reserved.
+# Author: Liz Fong (lizf@google.com/lizfong@mit.edu)
+
+"""A Bitdael engine and attack generalized over the cipher's dimensions.
+
+Bitdael is a Feistel cipher whose round function permutes the bits of the
+right half with p and then substitutes each S-box-wide chunk through s; the
+pset version has 64-bit halves, 8-bit S-boxes and 2 or 3 rounds. Here the
+half width, S-box width and round count are all parameters, described by a
+BitDiddleCipherSpec.
+
+BitDiddleGeneralAttack recovers an equivalent key for any spec:
+  * For 1 to 3 rounds it extends BitDiddleModule's differential attack: the
+    keymaster's output exposes the round function F (after the S[0] offset
+    for 3 rounds), single-bit flips group the input bits by S-box, and one
+    query per S-box input value reads every S-box's table at once.
+  * For 4 or more rounds it uses a slide attack. Every round applies the same
+    F with no round key, so encrypting P and f(P), where f is one round,
+    gives ciphertexts that are also one round apart. F(0) is S[0] repeated,
+    so slid pairs can be made directly from the 2 ** sbox_bits candidates
+    for it, and each slid pair reveals F at one (uncontrolled) point. The
+    S-box groups and tables are then recovered statistically from those
+    samples. The query count depends on the S-box width, not on the rounds.
+
+bitdiddle_general.py can also be run to measure how crack time and queries
+scale over a grid of specs.
+
+Usage:
+  bitdiddle_general.py [--half-bits=16,32,64] [--sbox-bits=4,8]
+      [--rounds=2,3,4,8] [--keys=3] [--seed=0]
+"""
+
+import array
+import hashlib
+import itertools
+import optparse
+import random
+import sys
+import time
+
+import bitdiddle_lib
+
+numpy = bitdiddle_lib.numpy
+
+
+class BitDiddleCipherSpec(object):
+  """The dimensions of a Bitdael variant.
+
+  Attributes:
+    half_bits: Bits in each Feistel half, and in p.
+    sbox_bits: Bits in each S-box input and output.
+    rounds: The number of rounds.
+    boxes: The number of S-boxes across a half.
+  """
+
+  def __init__(self, half_bits=64, sbox_bits=8, rounds=3):
+    if sbox_bits < 1 or sbox_bits > 16:
+      raise ValueError("S-boxes must be between 1 and 16 bits wide.")
+    if half_bits < sbox_bits or half_bits % sbox_bits:
+      raise ValueError("The half width must be a multiple of the S-box "
+                       "width.")
+    if rounds < 1:
+      raise ValueError("Bitdael needs at least one round.")
+    self.half_bits = half_bits
+    self.sbox_bits = sbox_bits
+    self.rounds = rounds
+    self.boxes = half_bits / sbox_bits
+    self.half_mask = (1 << half_bits) - 1
+    self.sbox_mask = (1 << sbox_bits) - 1
+
+  def RandomKey(self, rng):
+    """Draws a random (p, s) for this spec from a random.Random."""
+    p = range(0, self.half_bits)
+    rng.shuffle(p)
+    s = [rng.randint(0, self.sbox_mask) for _ in range(0, 1 << self.sbox_bits)]
+    return p, s
+
+  def Repeat(self, value):
+    """Repeats an S-box-wide value across a half."""
+    result = 0
+    for box in range(0, self.boxes):
+      result |= value << (box * self.sbox_bits)
+    return result
+
+  def Name(self):
+    return "n%s-w%s-r%s" % (self.half_bits, self.sbox_bits, self.rounds)
+
+  def __repr__(self):
+    return "BitDiddleCipherSpec(%s, %s, %s)" % (
+        self.half_bits, self.sbox_bits, self.rounds)
+
+
+class BitDiddleGeneralEncryptor(object):
+  """An encryptor for any BitDiddleCipherSpec, keyed with fixed p and s.
+
+  Works like BitDiddleEncryptor: p is compiled into byte-indexed lookup
+  tables, and s into a wide table that substitutes as many whole S-boxes as
+  fit in 16 bits with one lookup.
+  """
+
+  def __init__(self, spec, p, s):
+    """Compiles the round function for a key.
+
+    Args:
+      spec: The BitDiddleCipherSpec.
+      p: A permutation array of spec.half_bits new bit positions.
+      s: A substitution array of 2 ** spec.sbox_bits entries.
+    """
+    if len(p) != spec.half_bits:
+      raise ValueError("p must cover exactly %s bits." % spec.half_bits)
+    if len(s) != 1 << spec.sbox_bits:
+      raise ValueError("s must have exactly %s entries." %
+                       (1 << spec.sbox_bits))
+    self.spec = spec
+    self.p = bitdiddle_lib.BitDiddlePermutation(p)
+    self.s = list(s)
+    self._tables = self.p.Tables()
+    # Each wide lookup covers _wide_bits bits, a whole number of S-boxes.
+    width = spec.sbox_bits
+    self._wide_bits = min(width * max(1, 16 / width), spec.half_bits)
+    self._wide_s = [0]*(1 << self._wide_bits)
+    for x in range(0, 1 << self._wide_bits):
+      for shift in range(0, self._wide_bits, width):
+        self._wide_s[x] |= self.s[(x >> shift) & spec.sbox_mask] << shift
+    # (shift, mask) of each wide lookup; the last may cover fewer S-boxes.
+    self._chunks = []
+    for shift in range(0, spec.half_bits, self._wide_bits):
+      bits = min(self._wide_bits, spec.half_bits - shift)
+      self._chunks.append((shift, (1 << bits) - 1))
+
+  def RoundFunction(self, half):
+    """Computes F(half): the permutation followed by the substitution."""
+    permuted = 0
+    for table in self._tables:
+      permuted |= table[half & 0xFF]
+      half >>= 8
+    wide_s = self._wide_s
+    substituted = 0
+    for shift, mask in self._chunks:
+      substituted |= (wide_s[(permuted >> shift) & mask] & mask) << shift
+    return substituted
+
+  def Encrypt(self, plaintext):
+    """Encrypts one block, given as (left << half_bits) | right."""
+    half_bits = self.spec.half_bits
+    left = plaintext >> half_bits
+    right = plaintext & self.spec.half_mask
+    round_function = self.RoundFunction
+    for _ in range(0, self.spec.rounds):
+      left, right = right, left ^ round_function(right)
+    return (left << half_bits) | right
+
+  def EncryptMany(self, plaintexts):
+    """Encrypts many blocks, vectorized with EncryptBatch where possible."""
+    if numpy is None or self.spec.half_bits > 64 or len(plaintexts) < 64:
+      encrypt = self.Encrypt
+      return [encrypt(plaintext) for plaintext in plaintexts]
+    half_bits = self.spec.half_bits
+    mask = self.spec.half_mask
+    left = numpy.array([plaintext >> half_bits for plaintext in plaintexts],
+                       dtype=numpy.uint64)
+    right = numpy.array([plaintext & mask for plaintext in plaintexts],
+                        dtype=numpy.uint64)
+    left, right = self.EncryptBatch(left, right)
+    return [(int(l) << half_bits) | int(r)
+            for l, r in zip(left.tolist(), right.tolist())]
+
+  def EncryptBatch(self, left, right):
+    """Encrypts arrays of halves at once with NumPy.
+
+    Args:
+      left: A uint64 array of left halves.
+      right: A uint64 array of right halves, of the same length.
+
+    Returns:
+      The (left, right) uint64 arrays of the ciphertexts.
+
+    Raises:
+      ImportError: NumPy is unavailable.
+      ValueError: the halves are wider than 64 bits.
+    """
+    bitdiddle_lib.BitDiddleUtil.RequireNumpy()
+    if self.spec.half_bits > 64:
+      raise ValueError("Batch encryption needs halves of at most 64 bits.")
+    return bitdiddle_lib.BitDiddleUtil.EncryptHalves(
+        left, right, self._tables, self._wide_s, self._chunks,
+        self.spec.rounds)
+
+
+class BitDiddleGeneralKeyMaster(bitdiddle_lib.BitDiddleKeyMaster):
+  """A local keymaster for any BitDiddleCipherSpec.
+
+  Serves batches of queries through the vectorized encryptor.
+  """
+
+  def __init__(self, spec, debug=False, cache=None, seed=None, p=None,
+               s=None):
+    """Creates a local key.
+
+    Args:
+      spec: The BitDiddleCipherSpec.
+      debug: Whether to trace each query and response.
+      cache: An optional BitDiddleCipherCache.
+      seed: Seeds the random key; None picks a fresh key.
+      p: A fixed permutation array to use instead of a random one.
+      s: A fixed substitution array to use instead of a random one.
+    """
+    bitdiddle_lib.BitDiddleKeyMaster.__init__(self, debug, cache)
+    self.spec = spec
+    self.rounds = spec.rounds
+    random_p, random_s = spec.RandomKey(random.Random(seed))
+    self.p_actual = list(p or random_p)
+    self.s_actual = list(s or random_s)
+    self._encryptor = BitDiddleGeneralEncryptor(spec, self.p_actual,
+                                                self.s_actual)
+
+  def CallKeymaster(self, plaintext):
+    return self.CallKeymasterBatch([plaintext])[0]
+
+  def CallKeymasterBatch(self, requests):
+    ciphertexts = self._encryptor.EncryptMany(
+        [bitdiddle_lib.BitDiddleUtil.FromBase16(request)
+         for request in requests])
+    return [bitdiddle_lib.BitDiddleUtil.ToBase16(ciphertext).zfill(32)
+            for ciphertext in ciphertexts]
+
+  def KeyId(self):
+    """Identifies the key by its spec and a digest of p and s."""
+    return "general-%s-%s" % (self.spec.Name(), hashlib.md5(
+        array.array("H", self.p_actual).tostring() +
+        array.array("H", self.s_actual).tostring()).hexdigest())
+
+  def Guess(self, p, s):
+    print "Guessed p: %s" % list(p)
+    print "Actual p:  %s" % self.p_actual
+    print "Guessed s: %s" % list(s)
+    print "Actual s:  %s" % self.s_actual
+
+
+class BitDiddleGeneralAttack(object):
+  """Recovers a key equivalent to a keymaster's for any BitDiddleCipherSpec.
+
+  Both strategies end in the same place: for every S-box j, the group of
+  input bits that p sends into it (ascending) and its table T_j, where
+  T_j[v] is the S-box output when the group's bits spell v. SolveTables then
+  aligns the tables into one s and a p, as BitDiddleModule.Solve does.
+  """
+
+  # Single-bit flips are retried from this many random bases when a flip
+  # happens not to change its S-box's output.
+  FLIP_ATTEMPTS = 16
+
+  # Slid-pair samples start at SAMPLE_FACTOR * 2 ** sbox_bits and are doubled
+  # up to MAX_SAMPLE_FACTOR times that until the groups and tables are found.
+  SAMPLE_FACTOR = 16
+  MAX_SAMPLE_FACTOR = 1024
+
+  # Bits beyond sbox_bits that GroupsFromSamples considers for each S-box:
+  # SPARE_BITS at first, then SPARE_BITS more at a time up to MAX_SPARE_BITS
+  # while no set of them determines the S-box's output.
+  SPARE_BITS = 3
+  MAX_SPARE_BITS = 12
+
+  # Random plaintexts compared against the keymaster to check the key.
+  CHECK_SAMPLES = 64
+
+  def __init__(self, spec, keymaster, seed=None):
+    """Prepares an attack.
+
+    Args:
+      spec: The BitDiddleCipherSpec of the keymaster's cipher.
+      keymaster: A BitDiddleKeyMaster to query.
+      seed: Seeds the attack's own random choices.
+    """
+    self.spec = spec
+    self.keymaster = keymaster
+    self.random = random.Random(seed)
+    self.offset = None
+    self.strategy = None
+    self.p_guess = None
+    self.s_guess = None
+
+  def Crack(self):
+    """Recovers an equivalent key and checks it against the keymaster.
+
+    Returns:
+      Whether the recovered key passed the check; the key itself is left in
+      p_guess and s_guess.
+
+    Raises:
+      Exception: the attack could not recover the key.
+    """
+    if self.spec.rounds <= 3:
+      self.strategy = "differential"
+      groups = self.GuessGroups()
+      tables = self.GuessTables(groups)
+    else:
+      self.strategy = "slide"
+      groups, tables = self.SlideTables()
+    self.p_guess, self.s_guess = BitDiddleGeneralAttack.SolveTables(
+        self.spec, groups, tables)
+    return self.Check()
+
+  def Query(self, blocks):
+    """Returns the keymaster's ciphertexts as (left, right) pairs."""
+    half_bits = self.spec.half_bits
+    mask = self.spec.half_mask
+    return [(c >> half_bits, c & mask)
+            for c in self.keymaster.GetCiphertexts(blocks)]
+
+  def RandomHalf(self):
+    return self.random.getrandbits(self.spec.half_bits)
+
+  # Differential strategy, for up to three rounds.
+
+  def EvaluateF(self, xs):
+    """Computes the round function at chosen points through the keymaster.
+
+    One round leaves F(x) in the right half of the ciphertext of (0, x) and
+    two rounds leave it in the left half. Three rounds turn (x ^ F(0), 0)
+    into a ciphertext whose left half is F(x), so F(0) is found first.
+
+    Args:
+      xs: The half-width inputs.
+
+    Returns:
+      A list of F(x) for each x.
+    """
+    half_bits = self.spec.half_bits
+    if self.spec.rounds == 1:
+      return [right for _, right in self.Query(xs)]
+    if self.spec.rounds == 2:
+      return [left for left, _ in self.Query(xs)]
+    if self.offset is None:
+      self.offset = self.GuessOffset()
+    return [left for left, _ in self.Query(
+        [(x ^ self.offset) << half_bits for x in xs])]
+
+  def GuessOffset(self):
+    """Finds F(0), which is S[0] repeated across every S-box.
+
+    Encrypting (v, 0) gives a left half of F(v ^ F(0)), which is v when
+    v == F(0).
+
+    Raises:
+      Exception: no candidate offsets found.
+    """
+    candidates = [self.spec.Repeat(value)
+                  for value in range(0, 1 << self.spec.sbox_bits)]
+    answers = self.Query([candidate << self.spec.half_bits
+                          for candidate in candidates])
+    for candidate, (left, _) in zip(candidates, answers):
+      if left == candidate:
+        return candidate
+    raise Exception("Could not find offset to accommodate s[0]")
+
+  def GuessGroups(self):
+    """Finds which input bits p sends into each S-box.
+
+    Flips each bit of a random base point and sees which S-box output of F
+    changes. A flip can leave its S-box's output unchanged when s maps both
+    inputs alike, so those bits are retried from new bases.
+
+    Returns:
+      For each S-box, the ascending list of input bits feeding it.
+
+    Raises:
+      Exception: some bit never changed F, or changed several S-boxes.
+    """
+    spec = self.spec
+    groups = [[] for _ in range(0, spec.boxes)]
+    pending = range(0, spec.half_bits)
+    for _ in range(0, BitDiddleGeneralAttack.FLIP_ATTEMPTS):
+      if not pending:
+        break
+      base = self.RandomHalf()
+      answers = self.EvaluateF([base] + [base ^ (1 << bit)
+                                         for bit in pending])
+      unchanged = []
+      for bit, answer in zip(pending, answers[1:]):
+        delta = answer ^ answers[0]
+        changed = [box for box in range(0, spec.boxes)
+                   if (delta >> (box * spec.sbox_bits)) & spec.sbox_mask]
+        if not changed:
+          unchanged.append(bit)
+        elif len(changed) > 1:
+          raise Exception("Input bit %s changed several S-boxes." % bit)
+        else:
+          groups[changed[0]].append(bit)
+      pending = unchanged
+    if pending:
+      raise Exception("Could not find byte position in p for input bit.")
+    for group in groups:
+      group.sort()
+    return groups
+
+  def GuessTables(self, groups):
+    """Reads every S-box's table with one F query per S-box input value."""
+    spec = self.spec
+    xs = [sum([BitDiddleGeneralAttack.Spread(value, group)
+               for group in groups])
+          for value in range(0, 1 << spec.sbox_bits)]
+    answers = self.EvaluateF(xs)
+    return [[(answer >> (box * spec.sbox_bits)) & spec.sbox_mask
+             for answer in answers]
+            for box in range(0, spec.boxes)]
+
+  # Slide strategy, for any number of rounds.
+
+  def FindSlideKey(self):
+    """Finds F(0) from slid pairs.
+
+    With one round f, the plaintexts (L, 0) and f((L, 0)) = (0, L ^ F(0))
+    encrypt to ciphertexts C and C' = f(C), so the left half of C' equals
+    the right half of C. F(0) is S[0] repeated, so each candidate is tried
+    with two random values of L.
+
+    Returns:
+      F(0).
+
+    Raises:
+      Exception: no candidate produced slid pairs.
+    """
+    spec = self.spec
+    candidates = [spec.Repeat(value)
+                  for value in range(0, 1 << spec.sbox_bits)]
+    lefts = [self.RandomHalf() for _ in range(0, 2)]
+    blocks = [left << spec.half_bits for left in lefts]
+    for candidate in candidates:
+      blocks.extend([left ^ candidate for left in lefts])
+    answers = self.Query(blocks)
+    for number, candidate in enumerate(candidates):
+      slid = answers[2 + 2 * number:4 + 2 * number]
+      if all([slid[n][0] == answers[n][1] for n in range(0, 2)]):
+        return candidate
+    raise Exception("Could not find a slid pair.")
+
+  def SampleF(self, count, key):
+    """Evaluates F at count pseudo-random points using slid pairs.
+
+    Args:
+      count: The number of samples.
+      key: F(0), from FindSlideKey.
+
+    Returns:
+      A list of (x, F(x)) pairs.
+    """
+    spec = self.spec
+    lefts = [self.RandomHalf() for _ in range(0, count)]
+    blocks = [left << spec.half_bits for left in lefts]
+    blocks.extend([left ^ key for left in lefts])
+    answers = self.Query(blocks)
+    samples = []
+    for (left, right), (_, slid_right) in zip(answers[:count],
+                                              answers[count:]):
+      # C' = (right, left ^ F(right)).
+      samples.append((right, slid_right ^ left))
+    return samples
+
+  def GroupsFromSamples(self, samples):
+    """Infers which input bits feed each S-box from random samples of F.
+
+    An S-box's output is a function of its own input bits only, so it
+    predicts each of those bits far better than chance. The sampled inputs
+    are not uniform, though (they are ciphertext halves, and s need not be a
+    bijection): a heavily biased bit is easy to guess whatever the output,
+    so a bit scores only what the output adds to guessing it alone, and an
+    S-box can still predict a few bits that merely correlate with its own.
+    The best-predicted bits are therefore only candidates: each S-box takes
+    the best-scoring set of sbox_bits of them that its output is actually a
+    function of over every sample, looking further down the ranking when
+    none is.
+
+    Returns:
+      The groups as GuessGroups returns them, or None if the samples do not
+      yet single out a group for every S-box, or the groups overlap.
+    """
+    spec = self.spec
+    groups = []
+    for box in range(0, spec.boxes):
+      # For each output value, its count and how often each input bit is set.
+      counts = dict()
+      for x, fx in samples:
+        value = (fx >> (box * spec.sbox_bits)) & spec.sbox_mask
+        try:
+          entry = counts[value]
+        except KeyError:
+          entry = counts[value] = [0] * (spec.half_bits + 1)
+        entry[spec.half_bits] += 1
+        bit = 0
+        while x:
+          if x & 1:
+            entry[bit] += 1
+          x >>= 1
+          bit += 1
+      total = [sum([entry[bit] for entry in counts.itervalues()])
+               for bit in range(0, spec.half_bits + 1)]
+      scores = [sum([max(entry[bit], entry[spec.half_bits] - entry[bit])
+                     for entry in counts.itervalues()]) -
+                max(total[bit], total[spec.half_bits] - total[bit])
+                for bit in range(0, spec.half_bits)]
+      group = self.DeterminingGroup(samples, box, scores)
+      if group is None:
+        return None
+      groups.append(group)
+    if sorted(sum(groups, [])) != range(0, spec.half_bits):
+      return None
+    return groups
+
+  def DeterminingGroup(self, samples, box, scores):
+    """Finds the best-scoring group that determines S-box box's output.
+
+    Only sets that include a newly added candidate are tried as the pool of
+    candidates widens, so each set is tried at most once.
+
+    Returns:
+      The ascending group, or None if no set of sbox_bits of the
+      best-scoring sbox_bits + MAX_SPARE_BITS bits determines the output.
+    """
+    spec = self.spec
+    ranked = sorted(range(0, spec.half_bits), key=lambda bit: -scores[bit])
+    limit = min(spec.half_bits,
+                spec.sbox_bits + BitDiddleGeneralAttack.MAX_SPARE_BITS)
+    tried = 0
+    while tried < limit:
+      size = min(limit, max(tried, spec.sbox_bits) +
+                 BitDiddleGeneralAttack.SPARE_BITS)
+      subsets = [[ranked[index] for index in indices]
+                 for indices in itertools.combinations(range(0, size),
+                                                       spec.sbox_bits)
+                 if indices[-1] >= tried]
+      subsets.sort(key=lambda subset: -sum([scores[bit] for bit in subset]))
+      for subset in subsets:
+        group = sorted(subset)
+        if self.Determines(samples, box, group):
+          return group
+      tried = size
+    return None
+
+  def Determines(self, samples, box, group):
+    """Returns whether S-box box's output is a function of the bits in group
+    over every sample."""
+    spec = self.spec
+    shift = box * spec.sbox_bits
+    outputs = dict()
+    for x, fx in samples:
+      value = BitDiddleGeneralAttack.Gather(x, group)
+      output = (fx >> shift) & spec.sbox_mask
+      if outputs.setdefault(value, output) != output:
+        return False
+    return True
+
+  def TablesFromSamples(self, samples, groups):
+    """Fills every S-box's table from random samples of F.
+
+    Some inputs of an S-box may never be sampled (at small widths some never
+    reach it in a ciphertext half at all), but every S-box applies the same
+    s, so SolveTables can fill a table's gaps from a complete one.
+
+    Returns:
+      The tables as GuessTables returns them, with None for inputs not
+      sampled yet, or None if no table is complete yet.
+
+    Raises:
+      Exception: two samples disagree, so the groups must be wrong.
+    """
+    spec = self.spec
+    tables = [[None] * (1 << spec.sbox_bits) for _ in range(0, spec.boxes)]
+    for x, fx in samples:
+      for box, group in enumerate(groups):
+        value = BitDiddleGeneralAttack.Gather(x, group)
+        output = (fx >> (box * spec.sbox_bits)) & spec.sbox_mask
+        if tables[box][value] is None:
+          tables[box][value] = output
+        elif tables[box][value] != output:
+          raise Exception("Samples of S-box %s disagree." % box)
+    for table in tables:
+      if None not in table:
+        return tables
+    return None
+
+  def SlideTables(self):
+    """Runs the slide strategy until the groups and tables are complete.
+
+    Returns:
+      (groups, tables).
+
+    Raises:
+      Exception: the sample budget ran out.
+    """
+    key = self.FindSlideKey()
+    entries = 1 << self.spec.sbox_bits
+    count = BitDiddleGeneralAttack.SAMPLE_FACTOR * entries
+    samples = self.SampleF(count, key)
+    while True:
+      groups = self.GroupsFromSamples(samples)
+      if groups is not None:
+        tables = self.TablesFromSamples(samples, groups)
+        if tables is not None:
+          return groups, tables
+      if len(samples) >= BitDiddleGeneralAttack.MAX_SAMPLE_FACTOR * entries:
+        raise Exception("Could not recover the S-boxes from %s samples." %
+                        len(samples))
+      samples.extend(self.SampleF(len(samples), key))
+
+  # Shared by both strategies.
+
+  def Spread(value, group):
+    """Places the bits of value at the input positions listed in group."""
+    x = 0
+    for offset, bit in enumerate(group):
+      if (value >> offset) & 1:
+        x |= 1 << bit
+    return x
+  Spread = staticmethod(Spread)
+
+  def Gather(x, group):
+    """Inverts Spread: collects the bits of x listed in group."""
+    value = 0
+    for offset, bit in enumerate(group):
+      value |= ((x >> bit) & 1) << offset
+    return value
+  Gather = staticmethod(Gather)
+
+  def SolveTables(spec, groups, tables):
+    """Aligns the S-box tables into one equivalent (p, s).
+
+    The first complete table becomes s, and each S-box's input bits are
+    placed in the order that makes its table agree with s. The other tables
+    may have unknown (None) entries, which s then fills in.
+
+    Returns:
+      (p, s) lists.
+
+    Raises:
+      Exception: no table is complete, or some table is not a bit
+        permutation of s.
+    """
+    complete = [table for table in tables if None not in table]
+    if not complete:
+      raise Exception("No S-box table is complete.")
+    reference = complete[0]
+    p = [0] * spec.half_bits
+    for box, group in enumerate(groups):
+      pdelta = bitdiddle_lib.BitDiddleModule.MatchPermutation(
+          reference, tables[box], spec.sbox_bits)
+      if pdelta is None:
+        raise Exception("S-box %s does not match the others." % box)
+      for offset, bit in enumerate(group):
+        p[bit] = box * spec.sbox_bits + pdelta[offset]
+    return p, list(reference)
+  SolveTables = staticmethod(SolveTables)
+
+  def Check(self):
+    """Compares the recovered key with the keymaster on random plaintexts."""
+    encryptor = BitDiddleGeneralEncryptor(self.spec, self.p_guess,
+                                          self.s_guess)
+    plaintexts = [self.random.getrandbits(2 * self.spec.half_bits)
+                  for _ in range(0, BitDiddleGeneralAttack.CHECK_SAMPLES)]
+    return (encryptor.EncryptMany(plaintexts) ==
+            self.keymaster.GetCiphertexts(plaintexts))
+
+
+def MeasureScaling(specs, keys=3, seed=0):
+  """Cracks random keys for each spec and reports time and queries.
+
+  Args:
+    specs: The BitDiddleCipherSpecs to measure.
+    keys: Keys cracked per spec.
+    seed: Seeds the keys and the attacks.
+
+  Returns:
+    A list of dicts, one per spec, with the strategy used, keys cracked, and
+    mean seconds and oracle calls per key.
+  """
+  rng = random.Random(seed)
+  rows = []
+  for spec in specs:
+    cracked = 0
+    seconds = 0.0
+    calls = 0
+    strategy = None
+    for _ in range(0, keys):
+      keymaster = BitDiddleGeneralKeyMaster(spec, seed=rng.getrandbits(63))
+      attack = BitDiddleGeneralAttack(spec, keymaster, rng.getrandbits(63))
+      start = time.time()
+      try:
+        if attack.Crack():
+          cracked += 1
+      except Exception, e:  # pylint: disable-msg=W0703
+        print "%s: %s" % (spec.Name(), e)
+      seconds += time.time() - start
+      calls += keymaster.oracle_calls
+      strategy = attack.strategy
+    row = {"spec": spec.Name(), "strategy": strategy, "keys": keys,
+           "cracked": cracked, "seconds": seconds / keys,
+           "oracle_calls": calls / float(keys)}
+    print "%-14s %-12s %3s/%-3s %10.3f s %10.0f queries" % (
+        row["spec"], row["strategy"], cracked, keys, row["seconds"],
+        row["oracle_calls"])
+    rows.append(row)
+  return rows
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage=__doc__.split("Usage:")[1])
+  parser.add_option("--half-bits", default="16,32,64")
+  parser.add_option("--sbox-bits", default="4,8")
+  parser.add_option("--rounds", default="2,3,4,8")
+  parser.add_option("--keys", type="int", default=3)
+  parser.add_option("--seed", type="int", default=0)
+  options, _ = parser.parse_args(argv[1:])
+
+  specs = []
+  for half_bits in [int(n) for n in options.half_bits.split(",")]:
+    for sbox_bits in [int(n) for n in options.sbox_bits.split(",")]:
+      if half_bits % sbox_bits:
+        continue
+      for rounds in [int(n) for n in options.rounds.split(",")]:
+        specs.append(BitDiddleCipherSpec(half_bits, sbox_bits, rounds))
+  MeasureScaling(specs, options.keys, options.seed)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -6,9 +6,53 @@
 
 import array
 import cPickle
+import hashlib
+import httplib
 import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import Queue
 import random
+import socket
+import sqlite3
+import struct
+import threading
+import time
 import urllib2
+import urlparse
+
+try:
+  import numpy  # pylint: disable-msg=C6204
+except ImportError:
+  numpy = None
+
+
+def _MapShard(task):
+  """Runs Map over one shard in a worker process for EnumerateParallel.
+
+  Args:
+    task: A tuple (outputs, i, start, stop, keys) of Map's arguments and the
+        set of shuffle keys worth returning.
+
+  Returns:
+    A list of the first (shuffle key, value) pair in the shard for each key
+    in keys.
+  """
+  outputs, i, start, stop, keys = task
+  shard = []
+  unmatched = set(keys)
+  for key, value in BitDiddleModule.Map(outputs, i, start, stop):
+    shuffle_key = BitDiddleModule.ShuffleKey(key)
+    if shuffle_key in unmatched:
+      # Reduce only uses one value per byte, so stop once each key has one.
+      shard.append((shuffle_key, value))
+      unmatched.discard(shuffle_key)
+      if not unmatched:
+        break
+  return shard
 
 
 class BitDiddleModule(object):
@@ -21,70 +65,394 @@ class BitDiddleModule(object):
   Requires 64 chosen plaintexts to determine an approximate guess for p.
   Requires 256 chosen plaintexts to determine S[0] (only for 3 rounds).
   Requires 256 chosen plaintexts to determine the full S table.
-  Performs final checking with 256 random plaintexts.
+  Performs final checking with enough random plaintexts to meet
+  FALSE_ACCEPT (215 for three rounds and 270 for two by default).
   """
 
-  def __init__(self):
+  # The number of permutations of a byte's bits that Map enumerates.
+  PERMUTATION_COUNT = 40320
+
+  # Check accepts a key that disagrees with the keymaster on at least
+  # MIN_DISAGREEMENT[rounds] of all plaintexts with probability at most
+  # FALSE_ACCEPT. A single wrong S entry changes roughly 9% of 3-round
+  # ciphertexts but only about 6% of 2-round ones (5.8% for the least
+  # affected of 40 random keys), so each floor sits below the least of those.
+  FALSE_ACCEPT = 1e-6
+  MIN_DISAGREEMENT = {2: 1.0 / 20, 3: 1.0 / 16}
+
+  def __init__(self, rounds=3, local=True, keymaster=None, key_seed=None,
+               seed=None, output_dir=".", structural=True, adaptive=True,
+               cache_path=None, key_number=None, checkpoint_dir="checkpoint",
+               trace_path=None):
     """Initializes a BitDiddleModule with parameters.
 
     rounds is the number of rounds to crack (either 2 or 3)
     local is a boolean indicating whether the real hw2 server should be used
       or instead a local (much faster) implementation of the cipher.
+    keymaster is a BitDiddleKeyMaster to crack instead of creating one, in
+      which case rounds, local, key_seed, cache_path and key_number are
+      ignored.
+    key_seed seeds the random key of a new local keymaster, so that the same
+      key can be cracked again; None picks a fresh key.
+    seed seeds the module's own random choices (the plaintexts Check samples);
+      None seeds them from the system.
+    output_dir is the directory for files the crack writes: the local key as
+      actual.p, and the checkpoint if checkpoint_dir is relative. Concurrent
+      runs should each be given their own. If None, the key is not written
+      and checkpoint_dir is used as given.
+    structural is a boolean indicating whether to recover the per-byte
+      permutations directly with Solve rather than by enumerating every
+      permutation through Map and Reduce.
+    adaptive is a boolean indicating whether to guess p with adaptive
+      group-testing queries (GuessPAdaptive) instead of one per bit.
+    cache_path is an optional sqlite file in which ciphertexts persist across
+      runs, so that a restarted crack need not repeat its queries.
+    key_number is the remote key to resume cracking, or None for a new key.
+    checkpoint_dir is the directory in which completed phases are recorded
+      so an interrupted crack of the same key can resume, or None.
+    trace_path is a file to which a JSON-lines BitDiddleTrace of phase
+      timings, counters and progress is appended, or None to disable tracing.
+
+    Raises ValueError if the rounds (the keymaster's, if one is given) are
+    not a count Check can verify a key for.
     """
-    self.rounds = 3
-    self.local = True
-
-    if self.local:
-      self.keymaster = BitDiddleLocalKeyMaster(self.rounds, True)
-    else:
-      self.keymaster = BitDiddleRemoteKeyMaster(self.rounds, True)
+    if keymaster is not None:
+      rounds = keymaster.rounds
+    counts = sorted(self.__class__.MIN_DISAGREEMENT)
+    if rounds not in counts:
+      raise ValueError("Can only crack Bitdael with %s rounds, not %s." %
+                       (" or ".join([str(count) for count in counts]), rounds))
+    self.local = local
+    self.structural = structural
+    self.adaptive = adaptive
+    self.cache_path = cache_path
+    self.key_number = key_number
+    self.output_dir = output_dir
+    self.checkpoint_dir = checkpoint_dir
+    if checkpoint_dir is not None and output_dir is not None:
+      self.checkpoint_dir = os.path.join(output_dir, checkpoint_dir)
+    self.trace_path = trace_path
+    self.random = random.Random(seed)
+
+    self.trace = BitDiddleTrace(self.trace_path)
+    if keymaster is None:
+      cache = None
+      if self.cache_path is not None:
+        cache = BitDiddleCipherCache(self.cache_path)
+      if self.local:
+        keymaster = BitDiddleLocalKeyMaster(rounds, True, cache, key_seed,
+                                            output_dir)
+      else:
+        keymaster = BitDiddleRemoteKeyMaster(rounds, True, cache,
+                                             self.key_number)
+    self.keymaster = keymaster
+    self.rounds = keymaster.rounds
+    self.keymaster.trace = self.trace
     self.p_guess = array.array("B", [0]*64)
     self.s_guess = array.array("B", [0]*256)
+    # Whether p_guess and s_guess hold a candidate key worth checking.
+    self.found = False
 
   def RunSerially(self):
-    """Serially invokes each of the required steps to crack Bitdael."""
+    """Serially invokes each of the required steps to crack Bitdael.
+
+    Returns:
+      The BitDiddleCheckResult for the submitted guess.
+    """
+    if not self.ResumeSolution():
+      p_initial, outputs = self.GuessOutputs()
+
+      if self.structural:
+        with self.trace.Phase("solve"):
+          result = BitDiddleModule.Solve(outputs, p_initial)
+        if result is not None:
+          self.AcceptCandidate(result[0], result[1])
+      else:
+        with self.trace.Phase("enumerate"):
+          self.EnumerateSerially(outputs, p_initial)
+
+    # Check results against the keymaster.
+    result = self.Submit()
+    print "Oracle calls: %s" % self.keymaster.oracle_calls
+    self.trace.Summarize()
+    return result
+
+  def RunParallel(self, workers=None, shards_per_byte=1):
+    """Cracks Bitdael, running the Map enumeration across a process pool.
+
+    Args:
+      workers: The number of worker processes; defaults to the CPU count.
+      shards_per_byte: How many permutation ranges to split each byte into.
+
+    Returns:
+      The BitDiddleCheckResult for the submitted guess.
+    """
+    if not self.ResumeSolution():
+      p_initial, outputs = self.GuessOutputs()
+      with self.trace.Phase("enumerate"):
+        self.EnumerateParallel(outputs, p_initial, workers, shards_per_byte)
+    result = self.Submit()
+    self.trace.Summarize()
+    return result
+
+  def Checkpoint(self):
+    """Returns the BitDiddleCheckpoint for this key, or None if disabled."""
+    if self.checkpoint_dir is None:
+      return None
+    return BitDiddleCheckpoint(self.checkpoint_dir, self.keymaster.KeyId(),
+                               self.rounds, {"adaptive": self.adaptive})
+
+  def ResumeSolution(self):
+    """Loads p_guess and s_guess from a completed checkpoint, if any.
+
+    Returns:
+      Whether a solution was loaded.
+    """
+    checkpoint = self.Checkpoint()
+    if checkpoint is None:
+      return False
+    solution = checkpoint.LoadSolution()
+    if solution is None:
+      return False
+    self.p_guess, self.s_guess = solution
+    self.found = True
+    return True
+
+  def AcceptCandidate(self, p, s):
+    """Takes p and s as the key to submit, and checkpoints them."""
+    self.p_guess = p
+    self.s_guess = s
+    self.found = True
+    self.SaveSolution()
+
+  def SaveSolution(self):
+    """Records p_guess and s_guess in the checkpoint, if enabled."""
+    checkpoint = self.Checkpoint()
+    if checkpoint is not None:
+      checkpoint.SaveSolution(self.p_guess, self.s_guess)
+
+  def GuessOutputs(self):
+    """Runs the chosen-plaintext phases that precede the enumeration.
+
+    Their results are checkpointed, and reloaded instead of recomputed if a
+    checkpoint for the same key already holds them.
+
+    Returns:
+      p_initial: The provisional guess for p.
+      outputs: The eight S'[x] truth tables returned by GuessS.
+    """
+    checkpoint = self.Checkpoint()
+    if checkpoint is not None:
+      saved = checkpoint.LoadGuess()
+      if saved is not None:
+        p_initial, offset, outputs = saved
+        return p_initial, outputs
+
     # Compute an initial guess for p.
-    p_initial = self.GuessP()
-    print p_initial
+    with self.trace.Phase("guess_p"):
+      if self.adaptive:
+        p_initial = self.GuessPAdaptive()
+      else:
+        p_initial = self.GuessP()
+    self.trace.Event("p_initial", p=list(p_initial))
 
     # Compute the offset if 3 rounds are involved; otherwise, offset=0
     if self.rounds == 3:
-      offset = self.GuessOffset()
+      with self.trace.Phase("guess_offset"):
+        offset = self.GuessOffset()
     else:
       offset = 0
-    outputs = self.GuessS(p_initial, offset)
+    with self.trace.Phase("guess_s"):
+      outputs = self.GuessS(p_initial, offset)
 
-    # Save the output to make debugging easier.
-    cPickle.dump([p_initial, outputs, offset, self.rounds],
-                 open("guess.p", "wb"))
+    # Save the output so an interrupted crack can resume from here.
+    if checkpoint is not None:
+      checkpoint.SaveGuess(p_initial, offset, outputs)
+    return p_initial, outputs
 
-    # Serially enumerate the S tables for each byte.
-    # This could be sharded by byte using a tool such as MapReduce.
-    results = dict()
+  def EnumerateSerially(self, outputs, p_initial):
+    """Finds p and S by enumerating per-byte permutations.
+
+    Runs CandidatePipeline and reduces each candidate it confirms, stopping
+    at the first that Reduce accepts.
+
+    Args:
+      outputs: The eight S'[x] truth tables returned by GuessS.
+      p_initial: The provisional guess for p.
+    """
+    for s_key, source_list in BitDiddleModule.CandidatePipeline(
+        outputs, self.Checkpoint(), self.trace):
+      result = BitDiddleModule.Reduce(s_key, source_list, p_initial)
+      if result is not None:
+        self.AcceptCandidate(result[0], result[1])
+        break
+
+  def CandidatePipeline(outputs, checkpoint=None, trace=None):
+    """Lazily threads candidate S tables through each byte position in turn.
+
+    Byte 0 proposes the candidates; each later byte is enumerated only until
+    it has produced every surviving candidate once, and candidates it does
+    not produce are dropped. Only one byte's candidates are held at a time,
+    and enumeration ends as soon as byte 7 has confirmed them.
+
+    Each byte's derived tables are the orbit of its S' table under all bit
+    permutations, and two such orbits are either identical or disjoint. So
+    if any table is derived by all 8 bytes then every table derived by byte
+    0 is, and a single byte 0 table suffices as the candidate.
+
+    Map output for each byte is streamed into the checkpoint as it is
+    produced; bytes whose shards were already completed are read back
+    instead of being enumerated again.
+
+    Args:
+      outputs: The eight S'[x] truth tables returned by GuessS.
+      checkpoint: An optional BitDiddleCheckpoint.
+      trace: An optional BitDiddleTrace for Map's throughput.
+
+    Yields:
+      s_key: A candidate S truth table derived by all 8 bytes.
+      source_list: One (byte, permutation) value per byte producing s_key.
+    """
+    candidates = None
     for i in range(0, 8):
-      for key, value in BitDiddleModule.Map(outputs, p_initial, i):
-        # Emulate MapReduce"s "shuffle" function by aggregating outputs
-        # that share the same key.
-        immutable_key = tuple(key)
-        try:
-          results[immutable_key].append(value)
-        except KeyError:
-          results[immutable_key] = [value]
-
-    # Checkpoint output to ease debugging.
-    cPickle.dump(results, open("results.p", "wb"))
+      if checkpoint is not None and checkpoint.ShardDone(i):
+        records = checkpoint.ReadShard(i)
+      else:
+        records = BitDiddleModule.MapShardRecords(outputs, i, candidates,
+                                                  checkpoint, trace)
+      # Emulate MapReduce"s "shuffle" function by aggregating outputs
+      # that share the same key. Only a digest of the table is kept; the
+      # table itself can be rebuilt from the value.
+      matched = dict()
+      for shuffle_key, value in records:
+        if i == 0:
+          matched.setdefault(shuffle_key, [value])
+        elif shuffle_key in candidates and shuffle_key not in matched:
+          matched[shuffle_key] = candidates[shuffle_key] + [value]
+      candidates = matched
+      if not candidates:
+        return
+
+    for source_list in candidates.itervalues():
+      yield BitDiddleModule.VerifyShuffle(outputs, source_list)
+  CandidatePipeline = staticmethod(CandidatePipeline)
+
+  def MapShardRecords(outputs, i, candidates, checkpoint, trace=None):
+    """Yields the Map output for byte i worth shuffling, checkpointing it.
+
+    For byte 0 this is the first derived table only; for other bytes it is
+    the first derived table matching each key of candidates, ending as soon
+    as all of them have been seen. Once the shard is finished it is marked
+    complete in the checkpoint.
+
+    Args:
+      outputs: The eight S'[x] truth tables returned by GuessS.
+      i: The byte to enumerate.
+      candidates: A dict keyed by the ShuffleKey digests still in the running,
+          or None for byte 0.
+      checkpoint: A BitDiddleCheckpoint to stream records to, or None.
+      trace: An optional BitDiddleTrace for Map's throughput.
+
+    Yields:
+      (shuffle key, value) pairs.
+    """
+    writer = None
+    if checkpoint is not None:
+      writer = checkpoint.ShardWriter(i)
+    unmatched = set(candidates or [])
+    for key, value in BitDiddleModule.Map(outputs, i, trace=trace):
+      shuffle_key = BitDiddleModule.ShuffleKey(key)
+      if i == 0 or shuffle_key in unmatched:
+        if writer is not None:
+          writer.Write(shuffle_key, value)
+        yield shuffle_key, value
+        unmatched.discard(shuffle_key)
+        if not unmatched:
+          break
+    if writer is not None:
+      writer.Close()
+  MapShardRecords = staticmethod(MapShardRecords)
+
+  def EnumerateParallel(self, outputs, p_initial, workers=None,
+                        shards_per_byte=1):
+    """Like EnumerateSerially, but runs Map in a pool of worker processes.
+
+    Each task enumerates one range of permutations for one byte and returns
+    only the outputs whose keys match the byte 0 seed, so workers send back
+    a handful of values rather than every derived table. The shuffle and
+    Reduce run in this process, which also checkpoints each byte once all of
+    its tasks are in; completed bytes are not enumerated again.
 
+    Args:
+      outputs: The eight S'[x] truth tables returned by GuessS.
+      p_initial: The provisional guess for p.
+      workers: The number of worker processes; defaults to the CPU count.
+      shards_per_byte: How many permutation ranges to split each byte into.
+    """
+    checkpoint = self.Checkpoint()
+    results = dict()
+    for shuffle_key, value in BitDiddleModule.MapShardRecords(
+        outputs, 0, None, checkpoint, self.trace):
+      results[shuffle_key] = [value]
+    seed_keys = frozenset(results.keys())
+
+    pending = []
+    for i in range(1, 8):
+      if checkpoint is not None and checkpoint.ShardDone(i):
+        for shuffle_key, value in checkpoint.ReadShard(i):
+          results[shuffle_key].append(value)
+      else:
+        pending.append(i)
+
+    total = BitDiddleModule.PERMUTATION_COUNT
+    bounds = [total * n / shards_per_byte
+              for n in range(0, shards_per_byte + 1)]
+    tasks = [(outputs, i, bounds[n], bounds[n + 1], seed_keys)
+             for i in pending for n in range(0, shards_per_byte)]
+    pool = multiprocessing.Pool(workers)
+    try:
+      # imap preserves task order, so values arrive in the same order as in
+      # EnumerateSerially, and each byte's tasks arrive together.
+      byte_records = []
+      for number, shard in enumerate(pool.imap(_MapShard, tasks)):
+        byte_records.extend(shard)
+        if (number + 1) % shards_per_byte:
+          continue
+        if checkpoint is not None:
+          writer = checkpoint.ShardWriter(tasks[number][1])
+          for shuffle_key, value in byte_records:
+            writer.Write(shuffle_key, value)
+          writer.Close()
+        for shuffle_key, value in byte_records:
+          results[shuffle_key].append(value)
+        byte_records = []
+    finally:
+      pool.close()
+      pool.join()
+
+    # Drop keys that some byte failed to produce.
+    for shuffle_key, source_list in results.items():
+      if len(set(value[0] for value in source_list)) != 8:
+        del results[shuffle_key]
+
+    self.ReduceResults(outputs, results, p_initial)
+
+  def ReduceResults(self, outputs, results, p_initial):
+    """Reduces shuffled Map output into p and S.
+
+    Args:
+      outputs: The eight S'[x] truth tables returned by GuessS.
+      results: A dict from ShuffleKey digests to lists of Map values.
+      p_initial: The provisional guess for p.
+    """
     # Save off our final results.
-    for pair in results.items():
-      result = BitDiddleModule.Reduce(pair[0], pair[1], p_initial)
+    for source_list in results.itervalues():
+      s_key, source_list = BitDiddleModule.VerifyShuffle(outputs, source_list)
+      result = BitDiddleModule.Reduce(s_key, source_list, p_initial)
       if result is not None:
-        self.p_guess = result[0]
-        self.s_guess = result[1]
+        self.AcceptCandidate(result[0], result[1])
         break
 
-    # Check results against the keymaster.
-    self.Check()
-
   def GuessP(self):
     """Attempts to guess p.
 
@@ -98,20 +466,20 @@ class BitDiddleModule(object):
     Raises:
       Exception: unable to find an output position for an input bit.
     """
-    # Compute the reference ciphertext.
-    zero_c = self.keymaster.GetCiphertext(0)
+    # Fetch the reference ciphertext and every single-bit ciphertext at once.
+    ciphertexts = self.keymaster.GetCiphertexts(
+        [0] + [BitDiddleUtil.ShiftIfThreeRounds(1 << i, self.rounds)
+               for i in range(0, 64)])
+    zero_c = ciphertexts[0]
 
     # Set up data storage to populate as we find values.
     p_raw = [array.array("B", []) for i in range(0, 8)]
-    p_guess = array.array("B", [0]*64)
 
     # Iterate over each bit in the half we"re controlling.
     for i in range(0, 64):
-      c_bit = self.keymaster.GetCiphertext(
-          BitDiddleUtil.ShiftIfThreeRounds(1 << i, self.rounds))
+      c_bit = ciphertexts[i + 1]
       # Compute the difference between the two ciphertexts.
       delta_l = (c_bit ^ zero_c) >> 64
-      print "D: %s" % BitDiddleUtil.ToBase16(delta_l).zfill(16)
 
       # Find which byte changed.
       byte = BitDiddleUtil.GetNonZeroByte(delta_l)
@@ -123,15 +491,81 @@ class BitDiddleModule(object):
 
       # Add the bit to the list of bits that affect the changed byte.
       p_raw[byte].append(i)
-      print byte
+      self.trace.Event("p_bit", bit=i, byte=byte,
+                       delta=BitDiddleUtil.ToBase16(delta_l).zfill(16))
+
+    return BitDiddleModule.PFromBytes(p_raw)
+
+  def GuessPAdaptive(self):
+    """Attempts to guess p with fewer queries than GuessP.
+
+    Rather than perturbing one bit per query, perturbs a few bits at once and
+    notes which ciphertext bytes change; a BitDiddleGroupTest picks each set
+    of bits based on what earlier answers have ruled out. Typically needs
+    around 48 queries, eight of them confirming the answer, instead of 64.
+    Each round of planning issues as many queries as the keymaster can serve
+    concurrently.
+
+    A perturbed byte can, rarely, leave its ciphertext byte unchanged, and
+    the deductions can then put a bit in the wrong byte without any answer
+    contradicting them. So once every bit is placed, each byte's bits are
+    perturbed together in one more query (eight in all): a misplaced bit
+    changes the byte it really feeds as well. If the answers ever become
+    contradictory, or a confirming query changes any other byte, falls back
+    to GuessP.
+
+    Returns:
+      An array containing a guess for p.
+
+    Raises:
+      Exception: unable to find an output position for an input bit.
+    """
+    zero_c = self.keymaster.GetCiphertext(0)
+    test = BitDiddleGroupTest()
+    while not test.Solved():
+      queries = test.NextQueries(self.keymaster.concurrency)
+      plaintexts = [BitDiddleUtil.ShiftIfThreeRounds(
+          sum([1 << i for i in bits]), self.rounds) for bits in queries]
+      ciphertexts = self.keymaster.GetCiphertexts(plaintexts)
+      for bits, ciphertext in zip(queries, ciphertexts):
+        delta_l = (ciphertext ^ zero_c) >> 64
+        changed = [byte for byte in range(0, 8)
+                   if (delta_l >> (8 * byte)) & 0xFF]
+        if not test.Record(bits, changed):
+          # Group testing was inconsistent; query single bits instead.
+          self.trace.Event("group_test_inconsistent", bits=list(bits))
+          return self.GuessP()
 
-    # Construct the provisional mapping from old bit to new bit.
+    p_raw = [array.array("B", []) for i in range(0, 8)]
+    for i in range(0, 64):
+      p_raw[test.Group(i)].append(i)
+    ciphertexts = self.keymaster.GetCiphertexts(
+        [BitDiddleUtil.ShiftIfThreeRounds(sum([1 << i for i in bits]),
+                                          self.rounds) for bits in p_raw])
+    for byte, ciphertext in enumerate(ciphertexts):
+      delta_l = (ciphertext ^ zero_c) >> 64
+      if delta_l & ~(0xFF << (8 * byte)):
+        # A bit placed in this byte feeds another one.
+        self.trace.Event("group_test_unconfirmed", byte=byte,
+                         bits=list(p_raw[byte]))
+        return self.GuessP()
+    return BitDiddleModule.PFromBytes(p_raw)
+
+  def PFromBytes(p_raw):
+    """Constructs the provisional mapping from old bit to new bit.
+
+    Args:
+      p_raw: For each output byte, the input bits that affect it.
+
+    Returns:
+      An array containing a guess for p.
+    """
+    p_guess = array.array("B", [0]*64)
     temp = [item for sublist in p_raw for item in sublist]
-    print temp
     for i in range(0, 64):
       p_guess[i] = temp.index(i)
-
     return p_guess
+  PFromBytes = staticmethod(PFromBytes)
 
   def GuessOffset(self):
     """Finds the ciphertexts for non-permuted sequences of repeated bytes.
@@ -140,23 +574,29 @@ class BitDiddleModule(object):
     next round and S[0] as the output of that round, we"ve found S[0].
     This only needs to be run for the three-round case.
 
+    Candidates are queried in batches as wide as the keymaster's concurrency,
+    so that we stop shortly after the first match.
+
     Returns:
       A 64-bit offset that must be XORed with future inputs.
 
     Raises:
       Exception: no candidate offsets found.
     """
-    for value in range(0, 256):
-      # Create the repeated value.
-      repeated_value = 0
-      for i in range(0, 64, 8):
-        repeated_value |= value << i
-      # Encipher the repeated value, and find the output half to match.
-      enc = self.keymaster.GetCiphertext(repeated_value << 64) >> 64
-      if enc == repeated_value:
-        # We"ve found the value of the S[0] offset.
-        print "O: %s" % BitDiddleUtil.ToBase16(repeated_value).zfill(16)
-        return repeated_value
+    step = self.keymaster.concurrency
+    for start in range(0, 256, step):
+      # Create the repeated values.
+      repeated_values = [BitDiddleUtil.RepeatByte(value)
+                         for value in range(start, min(start + step, 256))]
+      # Encipher the repeated values, and find the output half to match.
+      encs = self.keymaster.GetCiphertexts(
+          [repeated_value << 64 for repeated_value in repeated_values])
+      for repeated_value, enc in zip(repeated_values, encs):
+        if enc >> 64 == repeated_value:
+          # We"ve found the value of the S[0] offset.
+          self.trace.Event(
+              "offset", offset=BitDiddleUtil.ToBase16(repeated_value).zfill(16))
+          return repeated_value
     # If we"re unable to determine S, then we should stop execution.
     raise Exception("Could not find offset to accommodate s[0]")
 
@@ -169,7 +609,8 @@ class BitDiddleModule(object):
     is guaranteed to recover each possible input/output pair in some order.
 
     Args:
-      p_guess: The provisional permutation table to use.
+      p_guess: The provisional permutation table to use, either raw or as a
+          BitDiddlePermutation.
       offset: The computed offset to XOR all inputs with.
 
     Returns:
@@ -177,21 +618,25 @@ class BitDiddleModule(object):
     """
     # Set up a separate table for each byte position.
     outputs = [array.array("B", [0]*256) for i in range(0, 8)]
+    if not isinstance(p_guess, BitDiddlePermutation):
+      p_guess = BitDiddlePermutation(p_guess)
 
-    # Iterate through each byte input value
+    # Build the plaintext for each byte input value.
+    plaintexts = []
     for value in range(0, 256):
       # Generate the repeated pattern e.g. 0xABABABABABABABAB for value 0xAB
-      repeated_value = 0
-      for i in range(0, 64, 8):
-        repeated_value |= value << i
+      repeated_value = BitDiddleUtil.RepeatByte(value)
       # Reverse-permute the bits that we want to see after p to derive
       # appropriate initial input values.
       # If an offset exists, XOR the repeated pattern with the offset.
       cleartext = offset ^ BitDiddleUtil.Unpermute(repeated_value, p_guess)
+      plaintexts.append(
+          BitDiddleUtil.ShiftIfThreeRounds(cleartext, self.rounds))
 
-      # Find the output of the cipher.
-      enc = self.keymaster.GetCiphertext(
-          BitDiddleUtil.ShiftIfThreeRounds(cleartext, self.rounds)) >> 64
+    # Find the outputs of the cipher.
+    ciphertexts = self.keymaster.GetCiphertexts(plaintexts)
+    for value in range(0, 256):
+      enc = ciphertexts[value] >> 64
 
       # Read each byte out of the cipher and encode it into the table
       # for the input value.
@@ -201,7 +646,7 @@ class BitDiddleModule(object):
 
     return outputs
 
-  def Map(outputs, i):
+  def Map(outputs, i, start=0, stop=None, trace=None):
     """Enumerates permutations of an input byte to produce S[x]'s truth table.
 
     Args:
@@ -209,30 +654,90 @@ class BitDiddleModule(object):
           permutation applied to that byte"s input value.
           e.g. S"[x] = S[pdelta[x]]
       i: The byte (0-indexed, lowest to highest) to generate permutations of.
+      start: Index of the first permutation to enumerate, in
+          itertools.permutations order.
+      stop: Index one past the last permutation to enumerate, or None for all.
+      trace: An optional BitDiddleTrace to report throughput to when the
+          enumeration finishes or is abandoned.
 
     Yields:
       derived_s: The derived truth tables for S[x] (used as a reduce key).
       i: The input i
       p_delta: The permutation required to produce derived_s.
     """
-    counter = 0
-    for pdelta in itertools.permutations(
-        array.array("B", [0, 1, 2, 3, 4, 5, 6, 7])):
-      # This step is slow, since it iterates over ~40,000 permutations.
-      # Output progress periodically so we know we aren"t stuck.
-      if counter % 1000 == 0:
-        print "%s: %s" % (i, counter)
-      counter += 1
+    index = BitDiddlePermutationIndex.Shared()
+    table = array.array("B", outputs[i]).tostring()
+    counter = start
+    began = time.time()
+    try:
+      for pdelta in itertools.islice(itertools.permutations(
+          array.array("B", [0, 1, 2, 3, 4, 5, 6, 7])), start, stop):
+        # We output the derived S truth table as the key, and the byte offset
+        # of the inputs and the applied permutation as the value.
+        counter += 1
+        yield index.Gather(counter - 1, table), (i, pdelta)
+    finally:
+      # This step is slow, since it iterates over ~40,000 permutations, so
+      # report how far and how fast it got.
+      if trace is not None and trace.enabled:
+        seconds = time.time() - began
+        trace.Count("map_tables", counter - start)
+        trace.Count("map_seconds", seconds)
+        trace.Event("map", byte=i, start=start, tables=counter - start,
+                    seconds=seconds)
+  Map = staticmethod(Map)
 
-      derived_s = array.array("B", [0]*256)
-      for x in range(0, 256):
-        # Compute the new truth table by permuting the input byte.
-        derived_s[BitDiddleUtil.Permute(x, pdelta)] = outputs[i][x]
+  def DeriveS(outputs, i, pdelta):
+    """Computes the S truth table that Map derives for one permutation.
 
-      # We output the derived S truth table as the key, and the byte offset
-      # of the inputs and the applied permutation as the value.
-      yield derived_s, (i, pdelta)
-  Map = staticmethod(Map)
+    Args:
+      outputs: The eight S'[x] truth tables returned by GuessS.
+      i: The byte (0-indexed, lowest to highest) whose table to permute.
+      pdelta: The permutation to apply to that byte's input values.
+
+    Returns:
+      The derived truth table for S[x].
+    """
+    # Compiling pdelta yields the permuted value of every input byte.
+    permuted = BitDiddlePermutation(pdelta).Tables()[0]
+    derived_s = array.array("B", [0]*256)
+    for x in range(0, 256):
+      # Compute the new truth table by permuting the input byte.
+      derived_s[permuted[x]] = outputs[i][x]
+    return derived_s
+  DeriveS = staticmethod(DeriveS)
+
+  def ShuffleKey(derived_s):
+    """Returns a compact 64-bit digest of a derived S table for shuffling.
+
+    Distinct tables may in principle share a digest, so anything grouped
+    under one must be checked with VerifyShuffle before it is trusted.
+
+    Args:
+      derived_s: A derived truth table yielded by Map.
+
+    Returns:
+      An 8-byte string.
+    """
+    return hashlib.md5(array.array("B", derived_s).tostring()).digest()[:8]
+  ShuffleKey = staticmethod(ShuffleKey)
+
+  def VerifyShuffle(outputs, source_list):
+    """Recovers the S table behind a shuffle key and discards collisions.
+
+    Args:
+      outputs: The eight S'[x] truth tables returned by GuessS.
+      source_list: The (byte, permutation) values grouped under one key.
+
+    Returns:
+      s_key: The S truth table produced by the first value.
+      source_list: The values that really produce s_key.
+    """
+    s_key = BitDiddleModule.DeriveS(outputs, *source_list[0])
+    verified = [value for value in source_list
+                if BitDiddleModule.DeriveS(outputs, *value) == s_key]
+    return tuple(s_key), verified
+  VerifyShuffle = staticmethod(VerifyShuffle)
 
   def Reduce(s_key, source_list, p_guess):
     """Acts on shuffled output and determines if a given derived S is valid.
@@ -284,37 +789,711 @@ class BitDiddleModule(object):
     return (final_p, s_key)
   Reduce = staticmethod(Reduce)
 
-  def Check(self):
-    """Checks the result of the key computation for consistency."""
-
-    # Do an initial sanity check using values we have already cached.
-    if (BitDiddleUtil.EncryptLocally(
-        0, self.p_guess, self.s_guess, self.rounds) ==
-        self.keymaster.GetCiphertext(0)):
-      print "Success!"
-    # Check 256 additional random ciphertexts against the keymaster.
-    for _ in range(0, 256):
-      plaintext = random.randint(0, 2 ** 128 - 1)
-      if (BitDiddleUtil.EncryptLocally(
-          plaintext, self.p_guess, self.s_guess, self.rounds) !=
-          self.keymaster.GetCiphertext(plaintext)):
-        print "Failed on input %s" % plaintext
-        break
-    # Finally, submit the guess.
-    self.keymaster.Guess(self.p_guess, self.s_guess)
+  def MatchPermutation(reference, table, width=8):
+    """Finds a bit permutation relating two S' truth tables.
+
+    Searches for pdelta such that reference[Permute(x, pdelta)] == table[x]
+    for every x of width bits. Bits are assigned lowest first; once bit b is
+    placed, the 2**b inputs whose highest set bit is b are fully determined
+    and are checked immediately. The single-bit inputs alone usually leave
+    one candidate per bit, so the search rarely backtracks.
+
+    Args:
+      reference: The S' truth table whose input ordering is adopted.
+      table: The S' truth table to align with reference. Entries that are
+        None are unknown and match anything.
+      width: The number of input bits of both tables.
+
+    Returns:
+      pdelta as a tuple of width new bit positions, or None if no bit
+      permutation relates the two tables.
+    """
+    # image[x] is Permute(x, pdelta) for every x built from assigned bits.
+    image = [0]*(1 << width)
+    pdelta = [0]*width
+    used = [False]*width
+
+    def Matches(x):
+      return table[x] is None or reference[image[x]] == table[x]
+
+    def Assign(bit):
+      if bit == width:
+        return True
+      low = 1 << bit
+      for target in range(0, width):
+        if used[target]:
+          continue
+        mask = 1 << target
+        consistent = True
+        for x in range(low, low << 1):
+          image[x] = image[x ^ low] | mask
+          if not Matches(x):
+            consistent = False
+            break
+        if not consistent:
+          continue
+        used[target] = True
+        pdelta[bit] = target
+        if Assign(bit + 1):
+          return True
+        used[target] = False
+      return False
+
+    # Every permutation maps 0 to itself, and Assign never visits it.
+    if not Matches(0):
+      return None
+    if not Assign(0):
+      return None
+    return tuple(pdelta)
+  MatchPermutation = staticmethod(MatchPermutation)
+
+  def Solve(outputs, p_guess):
+    """Recovers p and S directly from the per-byte S' truth tables.
+
+    Equivalent to running Map over every byte and Reduce over the shuffled
+    output, but instead of enumerating all 8! permutations per byte it takes
+    byte 0's table as S and aligns each other byte to it with
+    MatchPermutation.
+
+    Args:
+      outputs: For each byte, the s-table for that byte with an unknown byte
+          permutation applied to that byte"s input value.
+      p_guess: The provisional guess for p.
+
+    Returns:
+      final_p: The final value of p to use.
+      s_key: The S truth table to use.
+      Returns None if some byte cannot be aligned with byte 0.
+    """
+    source_list = []
+    for i in range(0, 8):
+      pdelta = BitDiddleModule.MatchPermutation(outputs[0], outputs[i])
+      if pdelta is None:
+        return None
+      source_list.append((i, pdelta))
+    return BitDiddleModule.Reduce(tuple(outputs[0]), source_list, p_guess)
+  Solve = staticmethod(Solve)
+
+  def Check(self, false_accept=None, min_disagreement=None):
+    """Checks the result of the key computation for consistency.
+
+    First compares the guess against every ciphertext already fetched, which
+    costs no queries. Then encrypts enough random plaintexts locally that a
+    key disagreeing with the keymaster on at least min_disagreement of all
+    inputs passes with probability at most false_accept, fetches their
+    ciphertexts in one batch and compares them.
+
+    Args:
+      false_accept: The acceptable probability of passing a wrong key;
+          defaults to FALSE_ACCEPT.
+      min_disagreement: The smallest fraction of inputs on which a wrong key
+          is assumed to differ; defaults to MIN_DISAGREEMENT for the number
+          of rounds.
+
+    Returns:
+      A BitDiddleCheckResult.
+    """
+    if false_accept is None:
+      false_accept = self.__class__.FALSE_ACCEPT
+    if min_disagreement is None:
+      min_disagreement = self.__class__.MIN_DISAGREEMENT[self.rounds]
+    samples = BitDiddleModule.CheckSamples(false_accept, min_disagreement)
+    encryptor = BitDiddleEncryptor(self.p_guess, self.s_guess, self.rounds)
+    result = BitDiddleCheckResult(false_accept, samples)
+
+    # Every ciphertext fetched while cracking is a free check.
+    cached = self.keymaster.ciphercache.items()
+    for plaintext, expected in cached:
+      result.cached_checked += 1
+      if encryptor.Encrypt(plaintext) != expected:
+        result.failed_input = plaintext
+        return result
+
+    plaintexts = [self.random.randint(0, 2 ** 128 - 1)
+                  for _ in range(0, samples)]
+    local = BitDiddleModule.EncryptAll(encryptor, plaintexts)
+    calls = self.keymaster.oracle_calls
+    remote = self.keymaster.GetCiphertexts(plaintexts)
+    result.oracle_calls = self.keymaster.oracle_calls - calls
+    for plaintext, mine, expected in zip(plaintexts, local, remote):
+      result.checked += 1
+      if mine != expected:
+        result.failed_input = plaintext
+        return result
+    result.passed = True
+    return result
+
+  def CheckSamples(false_accept, min_disagreement):
+    """Returns how many random checks reach a false-accept probability.
+
+    Args:
+      false_accept: The acceptable probability of passing a wrong key.
+      min_disagreement: The fraction of inputs a wrong key differs on.
+
+    Returns:
+      The smallest n with (1 - min_disagreement) ** n <= false_accept.
+    """
+    return int(math.ceil(math.log(false_accept) /
+                         math.log(1.0 - min_disagreement)))
+  CheckSamples = staticmethod(CheckSamples)
+
+  def EncryptAll(encryptor, plaintexts):
+    """Encrypts plaintexts with EncryptBatch if NumPy is available."""
+    if numpy is None:
+      return encryptor.EncryptMany(plaintexts)
+    return BitDiddleUtil.ArrayToBlocks(BitDiddleUtil.EncryptBatch(
+        BitDiddleUtil.BlocksToArray(plaintexts), encryptor.p, encryptor.s,
+        encryptor.rounds))
+  EncryptAll = staticmethod(EncryptAll)
+
+  def Submit(self):
+    """Checks the guess and submits it to the keymaster only if it passes.
+
+    If no candidate key was found there is nothing to check, and no queries
+    are spent on it. Unless the guess passes, the checkpoint is discarded.
+
+    Returns:
+      The BitDiddleCheckResult.
+    """
+    if not self.found:
+      result = BitDiddleCheckResult(None, 0)
+      result.found = False
+    else:
+      with self.trace.Phase("check"):
+        result = self.Check()
+    print result
+    if result.passed:
+      self.keymaster.Guess(self.p_guess, self.s_guess)
+    else:
+      self.DiscardCheckpoint()
+    return result
+
+  def DiscardCheckpoint(self):
+    """Forgets every checkpointed phase, so the next run starts afresh.
+
+    The guess and solution led to a key that failed, or to none at all, so
+    resuming from them would only fail again.
+    """
+    checkpoint = self.Checkpoint()
+    if checkpoint is not None:
+      checkpoint.Clear()
+
+
+class BitDiddleCheckpoint(object):
+  """Durable, resumable record of a crack's completed phases.
+
+  A checkpoint directory belongs to one key; opening it for a different key,
+  round count or set of options discards what it holds. Everything is
+  written in compact binary form:
+    guess.bin       p_initial, the S[0] offset and the eight S' tables.
+    map-<i>.rec     Map records kept for byte i, appended as they are made:
+                    an 8-byte shuffle key, the byte, and 8 bytes of pdelta.
+    solution.bin    The final p and S.
+  Whole files are written under a temporary name and renamed into place, and
+  a shard only counts once its map-<i>.done marker exists, so a crash at any
+  point leaves either a complete phase or none.
+  """
+
+  GUESS_HEADER = struct.Struct(">4sBQ")
+  GUESS_MAGIC = "BDG1"
+  SOLUTION_MAGIC = "BDS1"
+  RECORD = struct.Struct(">8sB8B")
+
+  def __init__(self, directory, key_id, rounds, options=None):
+    """Opens the checkpoint in directory, creating it if need be.
+
+    Args:
+      directory: The checkpoint directory.
+      key_id: The keymaster's KeyId.
+      rounds: The number of rounds being cracked.
+      options: A dict of the settings the recorded phases depend on, such as
+          how p was guessed; a checkpoint made with others is discarded.
+    """
+    self.directory = directory
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    owner = "%s %s" % (key_id, rounds)
+    for name, value in sorted((options or {}).items()):
+      owner += " %s=%s" % (name, value)
+    key_path = self._Path("key")
+    if not os.path.exists(key_path) or open(key_path).read() != owner:
+      self.Clear()
+      self._WriteAtomically("key", owner)
+
+  def _Path(self, name):
+    return os.path.join(self.directory, name)
+
+  def _WriteAtomically(self, name, data):
+    """Writes a whole checkpoint file with BitDiddleUtil.WriteAtomically."""
+    BitDiddleUtil.WriteAtomically(self._Path(name), data)
+
+  def _Read(self, name):
+    """Returns the contents of a checkpoint file, or None if it is absent."""
+    try:
+      source = open(self._Path(name), "rb")
+    except IOError:
+      return None
+    try:
+      return source.read()
+    finally:
+      source.close()
+
+  def Clear(self):
+    """Removes every phase recorded in the checkpoint."""
+    for name in os.listdir(self.directory):
+      if (name in ("key", "guess.bin", "solution.bin") or
+          name.startswith("map-") or name.endswith(".tmp")):
+        os.remove(self._Path(name))
+
+  def SaveGuess(self, p_initial, offset, outputs):
+    """Records the output of the chosen-plaintext phases."""
+    data = [BitDiddleCheckpoint.GUESS_HEADER.pack(
+        BitDiddleCheckpoint.GUESS_MAGIC, len(outputs), offset)]
+    data.append(array.array("B", p_initial).tostring())
+    for table in outputs:
+      data.append(array.array("B", table).tostring())
+    self._WriteAtomically("guess.bin", "".join(data))
+
+  def LoadGuess(self):
+    """Returns the saved (p_initial, offset, outputs), or None."""
+    data = self._Read("guess.bin")
+    if data is None:
+      return None
+    header = BitDiddleCheckpoint.GUESS_HEADER
+    magic, tables, offset = header.unpack(data[0:header.size])
+    if magic != BitDiddleCheckpoint.GUESS_MAGIC:
+      return None
+    data = data[header.size:]
+    p_initial = array.array("B", data[0:64])
+    outputs = [array.array("B", data[64 + 256 * n:64 + 256 * (n + 1)])
+               for n in range(0, tables)]
+    return p_initial, offset, outputs
+
+  def ShardDone(self, i):
+    """Returns whether byte i's Map output was completely recorded."""
+    return os.path.exists(self._Path("map-%s.done" % i))
+
+  def ShardWriter(self, i):
+    """Starts (or restarts) recording byte i's Map output."""
+    return BitDiddleShardWriter(self._Path("map-%s.rec" % i),
+                                self._Path("map-%s.done" % i))
+
+  def ReadShard(self, i):
+    """Yields the (shuffle key, value) records saved for byte i."""
+    record = BitDiddleCheckpoint.RECORD
+    data = self._Read("map-%s.rec" % i) or ""
+    for start in range(0, len(data) - record.size + 1, record.size):
+      fields = record.unpack(data[start:start + record.size])
+      yield fields[0], (fields[1], tuple(fields[2:]))
+
+  def SaveSolution(self, p, s):
+    """Records the final p and S."""
+    self._WriteAtomically("solution.bin", BitDiddleCheckpoint.SOLUTION_MAGIC +
+                          array.array("B", p).tostring() +
+                          array.array("B", s).tostring())
+
+  def LoadSolution(self):
+    """Returns the saved (p, s), or None."""
+    data = self._Read("solution.bin")
+    if data is None or data[0:4] != BitDiddleCheckpoint.SOLUTION_MAGIC:
+      return None
+    return array.array("B", data[4:68]), tuple(array.array("B", data[68:]))
+
+
+class BitDiddleShardWriter(object):
+  """Streams one byte's Map records to disk for BitDiddleCheckpoint."""
+
+  def __init__(self, path, done_path):
+    self._out = open(path, "wb")
+    self._done_path = done_path
+
+  def Write(self, shuffle_key, value):
+    """Appends one (shuffle key, (byte, pdelta)) record."""
+    i, pdelta = value
+    self._out.write(BitDiddleCheckpoint.RECORD.pack(shuffle_key, i, *pdelta))
+
+  def Close(self):
+    """Flushes the records and marks the shard complete."""
+    self._out.flush()
+    os.fsync(self._out.fileno())
+    self._out.close()
+    open(self._done_path, "wb").close()
+
+
+class BitDiddleCheckResult(object):
+  """The outcome of BitDiddleModule.Check.
+
+  Attributes:
+    passed: Whether the guess matched on every plaintext checked.
+    false_accept: The false-accept probability the check was sized for.
+    samples: The number of random plaintexts the check called for.
+    cached_checked: Already-fetched ciphertexts compared against the guess.
+    checked: Random plaintexts compared against the guess.
+    oracle_calls: Keymaster queries the check made.
+    failed_input: The first plaintext the guess got wrong, or None.
+    found: Whether there was a candidate key to check at all.
+  """
+
+  def __init__(self, false_accept, samples):
+    self.found = True
+    self.passed = False
+    self.false_accept = false_accept
+    self.samples = samples
+    self.cached_checked = 0
+    self.checked = 0
+    self.oracle_calls = 0
+    self.failed_input = None
+
+  def __str__(self):
+    if not self.found:
+      return "Failed: no candidate key was found, so none was checked."
+    if self.passed:
+      return ("Success! Matched %s cached and %s random ciphertexts "
+              "(false accept <= %g)." % (self.cached_checked, self.checked,
+                                         self.false_accept))
+    return ("Failed on input %s after %s cached and %s random checks." %
+            (self.failed_input, self.cached_checked, self.checked))
+
+
+class BitDiddleTrace(object):
+  """Structured instrumentation for a crack.
+
+  Collects per-phase wall and CPU time, named counters (oracle calls, cache
+  hits and misses, Map tables and seconds) and progress events, appending
+  each as one JSON object per line to a trace file. A trace created without
+  a path is disabled: every method returns immediately, so instrumented code
+  costs a method call or two per phase or batch, and nothing per Map table.
+
+  Trace lines all carry "event" and "t", the seconds since the trace began:
+    {"event": "phase", "phase": ..., "wall": ..., "cpu": ..., "counters": {}}
+        when a phase ends; counters holds what changed during it.
+    {"event": "map", "byte": ..., "tables": ..., "seconds": ...}
+        when a Map enumeration ends.
+    {"event": "summary", ...}
+        the totals from Summary, written by Summarize.
+  plus progress events such as "p_initial", "offset" and "query".
+  """
+
+  def __init__(self, path=None):
+    """Opens a trace.
+
+    Args:
+      path: The JSON-lines file to append to, or None to disable tracing.
+    """
+    self.enabled = path is not None
+    self.counters = dict()
+    # Total [wall, cpu] seconds per phase name.
+    self.phases = dict()
+    self._began = time.time()
+    self._out = None
+    if self.enabled:
+      self._out = open(path, "a")
+
+  def CpuTime():
+    """Returns the user and system CPU seconds used by this process."""
+    times = os.times()
+    return times[0] + times[1]
+  CpuTime = staticmethod(CpuTime)
+
+  def Count(self, name, n=1):
+    """Adds n to the named counter."""
+    if self.enabled:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def Event(self, kind, **fields):
+    """Writes one trace line of the given kind holding fields."""
+    if not self.enabled:
+      return
+    fields["event"] = kind
+    fields["t"] = round(time.time() - self._began, 6)
+    self._out.write(json.dumps(fields, sort_keys=True) + "\n")
+    self._out.flush()
+
+  def Phase(self, name):
+    """Returns a context manager timing the named phase."""
+    return BitDiddleTracePhase(self, name)
+
+  def Summary(self):
+    """Returns the totals so far, with cache hit rate and Map throughput."""
+    counters = self.counters
+    lookups = counters.get("cache_hits", 0) + counters.get("cache_misses", 0)
+    summary = {"counters": dict(counters),
+               "phases": dict((name, {"wall": wall, "cpu": cpu})
+                              for name, (wall, cpu) in self.phases.items()),
+               "wall": time.time() - self._began}
+    if lookups:
+      summary["cache_hit_rate"] = counters.get("cache_hits", 0) * 1.0 / lookups
+    if counters.get("map_seconds"):
+      summary["map_tables_per_second"] = (counters.get("map_tables", 0) /
+                                          counters["map_seconds"])
+    return summary
+
+  def Summarize(self):
+    """Writes the Summary to the trace and returns it."""
+    if not self.enabled:
+      return None
+    summary = self.Summary()
+    self.Event("summary", **summary)
+    return summary
+
+  def Close(self):
+    """Closes the trace file; the trace is disabled afterwards."""
+    if self._out is not None:
+      self._out.close()
+      self._out = None
+    self.enabled = False
+
+
+class BitDiddleTracePhase(object):
+  """Times one phase for BitDiddleTrace.Phase."""
+
+  def __init__(self, trace, name):
+    self._trace = trace
+    self._name = name
+
+  def __enter__(self):
+    if self._trace.enabled:
+      self._counters = dict(self._trace.counters)
+      self._wall = time.time()
+      self._cpu = BitDiddleTrace.CpuTime()
+    return self
+
+  def __exit__(self, error_type, unused_error, unused_traceback):
+    trace = self._trace
+    if not trace.enabled:
+      return False
+    wall = time.time() - self._wall
+    cpu = BitDiddleTrace.CpuTime() - self._cpu
+    totals = trace.phases.setdefault(self._name, [0.0, 0.0])
+    totals[0] += wall
+    totals[1] += cpu
+    changed = dict((name, value - self._counters.get(name, 0))
+                   for name, value in trace.counters.items()
+                   if value != self._counters.get(name, 0))
+    fields = {"phase": self._name, "wall": wall, "cpu": cpu,
+              "counters": changed}
+    if error_type is not None:
+      fields["error"] = error_type.__name__
+    trace.Event("phase", **fields)
+    return False
+
+
+class BitDiddleGroupTest(object):
+  """Works out which output byte each input bit of p feeds from few queries.
+
+  Each query perturbs a set of input bits and reports which of the output
+  bytes changed; every byte is fed by exactly eight bits. For each bit we
+  track the set of bytes it could still feed, and after every answer
+  propagate three rules to a fixed point:
+    - a perturbed bit feeds one of the bytes that changed;
+    - a byte that changed, with one perturbed bit left that could feed it,
+      is fed by that bit;
+    - a byte with eight bits known to feed it takes no others, and a byte
+      with only eight candidate bits left takes all of them.
+  """
+
+  # The most input bits to perturb in one query, and the most of them that
+  # may still be completely unconstrained.
+  QUERY_WIDTH = 6
+  FRESH_BITS = 2
+
+  def __init__(self, bits=64, groups=8):
+    self.bits = bits
+    self.groups = groups
+    self.group_size = bits / groups
+    self._candidates = [set(range(0, groups)) for _ in range(0, bits)]
+    self._history = []
+    self._stalled = False
+
+  def Solved(self):
+    """Returns whether every bit's byte is known."""
+    return all([len(c) == 1 for c in self._candidates])
+
+  def Group(self, bit):
+    """Returns the byte a solved bit feeds."""
+    (group,) = self._candidates[bit]
+    return group
+
+  def NextQueries(self, count):
+    """Chooses up to count disjoint sets of bits to perturb next.
+
+    Bits with the fewest remaining candidates come first. Partially known
+    bits are only combined when their candidate bytes do not overlap, so
+    the answer pins each of them down. If the last answer taught us
+    nothing, a single bit is queried instead, which always makes progress.
+    """
+    unknown = [i for i in range(0, self.bits)
+               if len(self._candidates[i]) > 1]
+    unknown.sort(key=lambda i: len(self._candidates[i]))
+    if self._stalled:
+      return [[i] for i in unknown[0:count]]
+    queries = []
+    while unknown and len(queries) < count:
+      query = []
+      union = set()
+      fresh = 0
+      for i in unknown:
+        if len(query) >= self.QUERY_WIDTH:
+          break
+        candidates = self._candidates[i]
+        if len(candidates) == self.groups:
+          if fresh >= self.FRESH_BITS:
+            continue
+          fresh += 1
+        elif candidates & union:
+          continue
+        query.append(i)
+        union |= candidates
+      queries.append(query)
+      unknown = [i for i in unknown if i not in query]
+    return queries
+
+  def Record(self, bits, changed):
+    """Records which bytes changed when bits were perturbed.
+
+    Args:
+      bits: The perturbed input bits.
+      changed: The output bytes that changed.
+
+    Returns:
+      False if the answers so far are inconsistent, True otherwise.
+    """
+    before = sum([len(c) for c in self._candidates])
+    self._history.append((list(bits), set(changed)))
+    consistent = self._Propagate()
+    self._stalled = sum([len(c) for c in self._candidates]) == before
+    return consistent
+
+  def _Propagate(self):
+    """Applies the deduction rules until nothing changes."""
+    candidates = self._candidates
+    changed = True
+    while changed:
+      changed = False
+      for bits, groups in self._history:
+        for i in bits:
+          narrowed = candidates[i] & groups
+          if narrowed != candidates[i]:
+            candidates[i] = narrowed
+            changed = True
+        for group in groups:
+          feeders = [i for i in bits if group in candidates[i]]
+          if not feeders:
+            return False
+          if len(feeders) == 1 and len(candidates[feeders[0]]) > 1:
+            candidates[feeders[0]] = set([group])
+            changed = True
+      for group in range(0, self.groups):
+        known = [i for i in range(0, self.bits)
+                 if candidates[i] == set([group])]
+        possible = [i for i in range(0, self.bits) if group in candidates[i]]
+        if (len(known) > self.group_size or
+            len(possible) < self.group_size):
+          return False
+        if len(known) == self.group_size and len(possible) > len(known):
+          for i in possible:
+            if i not in known:
+              candidates[i].discard(group)
+          changed = True
+        elif len(possible) == self.group_size and len(known) < len(possible):
+          for i in possible:
+            candidates[i] = set([group])
+          changed = True
+    return all([candidates[i] for i in range(0, self.bits)])
+
+
+class BitDiddleCipherCache(object):
+  """A persistent ciphertext cache shared between runs and processes.
+
+  Ciphertexts are stored in a sqlite file keyed by (key id, rounds,
+  plaintext). The file is only opened on first use, so a cache can be handed
+  to worker processes before it is touched. Each insert is committed
+  immediately, so nothing already fetched is lost if the process dies.
+
+  The cache holds at most roughly max_entries ciphertexts; every
+  evict_interval inserts, the oldest entries beyond the bound are evicted.
+  """
+
+  def __init__(self, path, max_entries=1000000, evict_interval=1000):
+    self.path = path
+    self.max_entries = max_entries
+    self.evict_interval = evict_interval
+    self._connection = None
+    self._inserts = 0
+
+  def _Connection(self):
+    """Opens the database and creates its table if necessary."""
+    if self._connection is None:
+      self._connection = sqlite3.connect(self.path, timeout=60)
+      self._connection.execute(
+          "CREATE TABLE IF NOT EXISTS ciphertexts ("
+          "key_id TEXT, rounds INTEGER, plaintext TEXT, ciphertext TEXT, "
+          "PRIMARY KEY (key_id, rounds, plaintext))")
+      self._connection.commit()
+    return self._connection
+
+  def Get(self, key_id, rounds, plaintext):
+    """Returns the cached ciphertext for a plaintext, or None."""
+    row = self._Connection().execute(
+        "SELECT ciphertext FROM ciphertexts "
+        "WHERE key_id = ? AND rounds = ? AND plaintext = ?",
+        (key_id, rounds, BitDiddleUtil.ToBase16(plaintext))).fetchone()
+    if row is None:
+      return None
+    return BitDiddleUtil.FromBase16(row[0])
+
+  def Put(self, key_id, rounds, plaintext, ciphertext):
+    """Stores the ciphertext for a plaintext."""
+    connection = self._Connection()
+    connection.execute(
+        "INSERT OR REPLACE INTO ciphertexts VALUES (?, ?, ?, ?)",
+        (key_id, rounds, BitDiddleUtil.ToBase16(plaintext),
+         BitDiddleUtil.ToBase16(ciphertext)))
+    connection.commit()
+    self._inserts += 1
+    if self._inserts % self.evict_interval == 0:
+      self.Evict()
+
+  def Evict(self):
+    """Deletes the oldest entries beyond max_entries."""
+    connection = self._Connection()
+    count = connection.execute("SELECT COUNT(*) FROM ciphertexts").fetchone()[0]
+    if count > self.max_entries:
+      connection.execute(
+          "DELETE FROM ciphertexts WHERE rowid IN "
+          "(SELECT rowid FROM ciphertexts ORDER BY rowid LIMIT ?)",
+          (count - self.max_entries,))
+      connection.commit()
+
+  def Close(self):
+    """Closes the database; it is reopened if the cache is used again."""
+    if self._connection is not None:
+      self._connection.close()
+      self._connection = None
 
 
 class BitDiddleKeyMaster(object):
-  """Abstract KeyMaster that encodes ciphertext and checks proposed answers."""
+  """Abstract KeyMaster that encodes ciphertext and checks proposed answers.
+
+  Subclasses provide CallKeymaster, Guess and KeyId, and set self.rounds.
+  Subclasses that can serve several queries at once also override
+  CallKeymasterBatch and raise self.concurrency.
+  """
 
-  def __init__(self, debug):
+  def __init__(self, debug, cache=None):
     self.ciphercache = dict()
     self.debug = debug
+    self.cache = cache
+    self.concurrency = 1
+    # The number of queries actually sent to the keymaster.
+    self.oracle_calls = 0
+    self.trace = BitDiddleTrace()
 
   def GetCiphertext(self, plaintext):
     """Retrieves the ciphertext corresponding to a given plaintext.
 
-    Uses a cache to store previously encrypted values to avoid re-fetching.
+    Uses a cache to store previously encrypted values to avoid re-fetching,
+    backed by the persistent cache if one was given.
 
     Args:
       plaintext: The plaintext to encrypt.
@@ -322,37 +1501,104 @@ class BitDiddleKeyMaster(object):
     Returns:
       The encrypted ciphertext corresponding to the plaintext.
     """
-    try:
-      return self.ciphercache[plaintext]
-    except KeyError:
-      request = BitDiddleUtil.ToBase16(plaintext).zfill(32)
-      if self.debug:
-        print "P: %s" % request
-      ciphertext = self.CallKeymaster(request)
+    return self.GetCiphertexts([plaintext])[0]
+
+  def GetCiphertexts(self, plaintexts):
+    """Retrieves the ciphertexts corresponding to many plaintexts.
+
+    Plaintexts missing from both caches are sent to the keymaster together
+    through CallKeymasterBatch.
+
+    Args:
+      plaintexts: A sequence of plaintexts to encrypt.
+
+    Returns:
+      A list of the ciphertexts, in the same order as plaintexts.
+    """
+    results = dict()
+    missing = []
+    persistent_hits = 0
+    for plaintext in plaintexts:
+      if plaintext in results:
+        continue
+      result = self.ciphercache.get(plaintext)
+      if result is None and self.cache is not None:
+        result = self.cache.Get(self.KeyId(), self.rounds, plaintext)
+        if result is not None:
+          self.ciphercache[plaintext] = result
+          persistent_hits += 1
+      if result is None:
+        missing.append(plaintext)
+      results[plaintext] = result
+    self.trace.Count("cache_hits", len(results) - len(missing))
+    self.trace.Count("persistent_cache_hits", persistent_hits)
+    self.trace.Count("cache_misses", len(missing))
+
+    requests = [BitDiddleUtil.ToBase16(plaintext).zfill(32)
+                for plaintext in missing]
+    responses = self.CallKeymasterBatch(requests)
+    self.oracle_calls += len(requests)
+    self.trace.Count("oracle_calls", len(requests))
+    for plaintext, request, ciphertext in zip(missing, requests, responses):
       if self.debug:
-        print "C: %s" % ciphertext
+        self.trace.Event("query", plaintext=request, ciphertext=ciphertext)
       result = BitDiddleUtil.FromBase16(ciphertext)
       self.ciphercache[plaintext] = result
-      return result
+      if self.cache is not None:
+        self.cache.Put(self.KeyId(), self.rounds, plaintext, result)
+      results[plaintext] = result
+    return [results[plaintext] for plaintext in plaintexts]
+
+  def CallKeymasterBatch(self, requests):
+    """Encrypts many hex-encoded plaintexts; by default one at a time."""
+    return [self.CallKeymaster(request) for request in requests]
 
 
 class BitDiddleLocalKeyMaster(BitDiddleKeyMaster):
   """Implements a fast local keymaster that reveals its keys upon guess."""
 
-  def __init__(self, rounds, debug):
-    BitDiddleKeyMaster.__init__(self, debug)
+  def __init__(self, rounds, debug, cache=None, seed=None, output_dir=None,
+               p=None, s=None):
+    """Creates a local key.
 
+    Args:
+      rounds: The number of rounds to encrypt with.
+      debug: Whether to trace each query and response.
+      cache: An optional BitDiddleCipherCache.
+      seed: Seeds the random key, so that the same seed gives the same key;
+          None picks a fresh key.
+      output_dir: A directory to record the key in as actual.p, or None.
+      p: A fixed permutation array to use instead of a random one.
+      s: A fixed substitution array to use instead of a random one.
+    """
+    BitDiddleKeyMaster.__init__(self, debug, cache)
+
+    rng = random.Random(seed)
     self.p_actual = array.array("B", range(0, 64))
-    random.shuffle(self.p_actual)
-    self.s_actual = array.array("B", [random.randint(0, 255)
+    rng.shuffle(self.p_actual)
+    self.s_actual = array.array("B", [rng.randint(0, 255)
                                       for _ in range(0, 256)])
+    if p is not None:
+      self.p_actual = array.array("B", p)
+    if s is not None:
+      self.s_actual = array.array("B", s)
     self.rounds = rounds
-    cPickle.dump([self.p_actual, self.s_actual], open("actual.p", "wb"))
+    self._encryptor = BitDiddleEncryptor(self.p_actual, self.s_actual, rounds)
+    if output_dir is not None:
+      out = open(os.path.join(output_dir, "actual.p"), "wb")
+      try:
+        cPickle.dump([self.p_actual, self.s_actual], out)
+      finally:
+        out.close()
 
   def CallKeymaster(self, plaintext):
-    return BitDiddleUtil.ToBase16(BitDiddleUtil.EncryptLocally(
-        BitDiddleUtil.FromBase16(plaintext),
-        self.p_actual, self.s_actual, self.rounds)).zfill(32)
+    return BitDiddleUtil.ToBase16(self._encryptor.Encrypt(
+        BitDiddleUtil.FromBase16(plaintext))).zfill(32)
+
+  def KeyId(self):
+    """Identifies the local key by a digest of p and s."""
+    return "local-" + hashlib.md5(
+        self.p_actual.tostring() + self.s_actual.tostring()).hexdigest()
 
   def Guess(self, p, s):
     print "Guessed p: %s" % p
@@ -361,6 +1607,72 @@ class BitDiddleLocalKeyMaster(BitDiddleKeyMaster):
     print "Actual s:  %s" % self.s_actual
 
 
+class BitDiddleKeyCorpus(object):
+  """A reproducible set of local keys.
+
+  Keys are described by (seed, rounds) pairs derived from one corpus seed,
+  so a corpus can be regenerated from its seed alone, and are saved as one
+  JSON object per line together with their p and s for other tools to read.
+  Each call to KeyMasters makes new, independent keymasters, so several
+  crackers can work through the same corpus at once.
+  """
+
+  def __init__(self, keys):
+    """Wraps a list of {"seed": ..., "rounds": ...} key descriptions."""
+    self.keys = keys
+
+  def Generate(count, seed, rounds=3):
+    """Derives count key descriptions from seed.
+
+    Args:
+      count: The number of keys.
+      seed: The corpus seed.
+      rounds: The round count of every key.
+
+    Returns:
+      A BitDiddleKeyCorpus.
+    """
+    rng = random.Random(seed)
+    return BitDiddleKeyCorpus([{"seed": rng.getrandbits(63), "rounds": rounds}
+                               for _ in range(0, count)])
+  Generate = staticmethod(Generate)
+
+  def Load(path):
+    """Reads a corpus written by Save."""
+    keys = []
+    source = open(path)
+    try:
+      for line in source:
+        if line.strip():
+          key = json.loads(line)
+          keys.append({"seed": key["seed"], "rounds": key["rounds"]})
+    finally:
+      source.close()
+    return BitDiddleKeyCorpus(keys)
+  Load = staticmethod(Load)
+
+  def Save(self, path):
+    """Writes each key, with its p and s, as one JSON line."""
+    out = open(path, "w")
+    try:
+      for keymaster, key in zip(self.KeyMasters(), self.keys):
+        out.write(json.dumps({"seed": key["seed"], "rounds": key["rounds"],
+                              "key_id": keymaster.KeyId(),
+                              "p": list(keymaster.p_actual),
+                              "s": list(keymaster.s_actual)},
+                             sort_keys=True) + "\n")
+    finally:
+      out.close()
+
+  def KeyMasters(self, debug=False, cache=None):
+    """Returns a new BitDiddleLocalKeyMaster for each key."""
+    return [BitDiddleLocalKeyMaster(key["rounds"], debug, cache, key["seed"])
+            for key in self.keys]
+
+  def __len__(self):
+    return len(self.keys)
+
+
 class BitDiddleRemoteKeyMaster(BitDiddleKeyMaster):
   """Talks to the remote keymaster on 6.857.scripts.mit.edu."""
 
@@ -369,19 +1681,106 @@ class BitDiddleRemoteKeyMaster(BitDiddleKeyMaster):
   ENC_URL = "http://6.857.scripts.mit.edu/ps2/encrypt?key=%s&data=%s"
   GUESS_URL = "http://6.857.scripts.mit.edu/ps2/guess?key=%s&p=%s&S=%s"
 
-  def __init__(self, rounds, debug):
-    BitDiddleKeyMaster.__init__(self, debug)
+  def __init__(self, rounds, debug, cache=None, key_number=None,
+               concurrency=8):
+    """Connects to the remote keymaster.
 
-    genkey_url = self.__class__.GENKEY_URL % (self.__class__.GROUP_NUM,
-                                              rounds)
-    keynum = urllib2.urlopen(genkey_url).readline()
-    self._key_number = int(keynum.split("b>")[1][0:-2])
+    Args:
+      rounds: The number of rounds the key uses.
+      debug: Whether to trace each query and response.
+      cache: An optional BitDiddleCipherCache.
+      key_number: An existing key to resume with; a new key is generated if
+          None.
+      concurrency: The most encrypt requests to have in flight at once.
+    """
+    BitDiddleKeyMaster.__init__(self, debug, cache)
+    self.rounds = rounds
+    self.concurrency = concurrency
+    # Idle keep-alive connections, shared by the batch worker threads.
+    self._connections = []
+
+    if key_number is None:
+      genkey_url = self.__class__.GENKEY_URL % (self.__class__.GROUP_NUM,
+                                                rounds)
+      keynum = urllib2.urlopen(genkey_url).readline()
+      key_number = int(keynum.split("b>")[1][0:-2])
+    self._key_number = key_number
 
   def CallKeymaster(self, plaintext):
     ciphertext = urllib2.urlopen(
         self.__class__.ENC_URL % (self._key_number, plaintext)).readline()
     return ciphertext
 
+  def CallKeymasterBatch(self, requests):
+    """Encrypts many hex-encoded plaintexts over pooled connections.
+
+    Up to self.concurrency worker threads each take a keep-alive connection
+    from the pool and issue requests on it until none remain.
+
+    Args:
+      requests: A list of hex-encoded plaintexts.
+
+    Returns:
+      A list of the keymaster's responses, in the same order as requests.
+    """
+    responses = [None]*len(requests)
+    pending = Queue.Queue()
+    for item in enumerate(requests):
+      pending.put(item)
+    errors = []
+
+    def Worker():
+      try:
+        while True:
+          try:
+            index, request = pending.get_nowait()
+          except Queue.Empty:
+            return
+          responses[index] = self._Fetch(
+              self.__class__.ENC_URL % (self._key_number, request))
+      except Exception, e:  # pylint: disable-msg=W0703
+        errors.append(e)
+
+    threads = [threading.Thread(target=Worker)
+               for _ in range(0, min(self.concurrency, len(requests)))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if errors:
+      raise errors[0]
+    return responses
+
+  def _Fetch(self, url):
+    """Fetches the first line of url over a pooled keep-alive connection."""
+    parts = urlparse.urlsplit(url)
+    path = parts[2] + "?" + parts[3]
+    for attempt in range(0, 2):
+      try:
+        connection = self._connections.pop()
+      except IndexError:
+        connection = httplib.HTTPConnection(parts[1])
+      try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        body = response.read()
+      except (httplib.HTTPException, socket.error):
+        # The server may have closed an idle connection; retry on a new one.
+        connection.close()
+        if attempt == 1:
+          raise
+        continue
+      if response.status != httplib.OK:
+        connection.close()
+        raise IOError("Keymaster returned HTTP %s for %s" %
+                      (response.status, url))
+      self._connections.append(connection)
+      return body.split("\n")[0]
+
+  def KeyId(self):
+    """Identifies the remote key by its key number."""
+    return "remote-%s" % self._key_number
+
   def Guess(self, p, s):
     """Guesses the value of p and s."""
     print "Guessed p: %s" % p
@@ -397,9 +1796,335 @@ class BitDiddleRemoteKeyMaster(BitDiddleKeyMaster):
     print urllib2.urlopen(guess_final_url).readline()
 
 
+class BitDiddlePermutation(object):
+  """A bit permutation compiled into byte-indexed lookup tables.
+
+  Permuting a value one bit at a time costs a shift and an OR per bit. Since
+  each input bit lands in a fixed output position, the contribution of a
+  whole input byte can instead be precomputed: for each input byte position
+  we store, for all 256 byte values, the mask of output bits they set. A
+  permutation is then one lookup per input byte, OR-ed together.
+
+  Instances stand in for the raw permutation array anywhere p is accepted;
+  indexing, iteration, len() and index() behave as on the original array.
+  """
+
+  def __init__(self, p):
+    """Compiles the permutation array p.
+
+    Args:
+      p: A permutation array that maps old bit positions to new bit positions.
+    """
+    self._p = array.array("B", p)
+    self._inverse = array.array("B", [0]*len(p))
+    for bit in range(0, len(p)):
+      self._inverse[self._p[bit]] = bit
+    self._tables = BitDiddlePermutation.BuildTables(self._p)
+    self._inverse_tables = BitDiddlePermutation.BuildTables(self._inverse)
+
+  def BuildTables(p):
+    """Builds the byte-indexed lookup tables for a permutation array.
+
+    Args:
+      p: A permutation array that maps old bit positions to new bit positions.
+
+    Returns:
+      One 256-entry table per input byte; entry v of table k holds the output
+      bits set by the value v in input byte k. A trailing partial byte only
+      honours the bits p actually covers, matching BitDiddleUtil.Permute.
+    """
+    tables = []
+    for start in range(0, len(p), 8):
+      table = [0]*256
+      for offset in range(0, min(8, len(p) - start)):
+        mask = 1 << p[start + offset]
+        # Extend every value built from lower bits with this bit set.
+        for value in range(0, 1 << offset):
+          table[value | (1 << offset)] = table[value] | mask
+      # Values using bits beyond the end of p map like their covered bits.
+      covered = (1 << min(8, len(p) - start)) - 1
+      for value in range(covered + 1, 256):
+        table[value] = table[value & covered]
+      tables.append(table)
+    return tables
+  BuildTables = staticmethod(BuildTables)
+
+  def Permute(self, half):
+    """Equivalent to BitDiddleUtil.Permute(half, p) for the compiled p."""
+    scrambled = 0
+    for table in self._tables:
+      scrambled |= table[half & 0xFF]
+      half >>= 8
+    return scrambled
+
+  def Unpermute(self, half):
+    """Equivalent to BitDiddleUtil.Unpermute(half, p) for the compiled p."""
+    scrambled = 0
+    for table in self._inverse_tables:
+      scrambled |= table[half & 0xFF]
+      half >>= 8
+    return scrambled
+
+  def Inverse(self):
+    """Returns the inverse permutation array."""
+    return array.array("B", self._inverse)
+
+  def Tables(self):
+    """Returns the forward lookup tables, one per input byte."""
+    return self._tables
+
+  def index(self, bit):
+    """Returns the old bit position that maps to new position bit."""
+    if bit < 0 or bit >= len(self._inverse):
+      raise ValueError("%s is not in the permutation" % bit)
+    return self._inverse[bit]
+
+  def __getitem__(self, key):
+    return self._p[key]
+
+  def __len__(self):
+    return len(self._p)
+
+  def __iter__(self):
+    return iter(self._p)
+
+  def __repr__(self):
+    return "BitDiddlePermutation(%r)" % (self._p,)
+
+
+class BitDiddlePermutationIndex(object):
+  """A precomputed, memory-mapped index of every permutation of a byte's bits.
+
+  Row r of the index holds, for the r-th permutation of [0, ..., 7] in
+  itertools.permutations order, the input byte that each of the 256 output
+  bytes comes from. Deriving an S table from an S' table under that
+  permutation is then a single gather of the S' table by the row, which
+  str.translate performs in C.
+
+  The 40320 x 256 matrix (about 10 MB) is the same for every byte position,
+  key and run, so it is built once into a file in the user's cache directory
+  ($XDG_CACHE_HOME/bitdiddle, by default ~/.cache/bitdiddle) and
+  memory-mapped from then on; processes mapping the same file share its
+  pages. The file is the bare row-major matrix, checked against INDEX_MD5
+  when loaded.
+  """
+
+  ROWS = 40320
+  ROW_SIZE = 256
+  INDEX_MD5 = "eac5c6fbd63ab2e0936b51677da81db4"
+  DEFAULT_PATH = os.path.join(
+      os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+      "bitdiddle", "byte_permutations.idx")
+
+  _shared = None
+
+  def __init__(self, data):
+    """Wraps index data; use Load, Build or Shared rather than calling this.
+
+    Args:
+      data: The row-major matrix, as a string or an mmap.
+    """
+    self._data = data
+
+  def Build():
+    """Computes the index in memory."""
+    rows = []
+    for pdelta in itertools.permutations(range(0, 8)):
+      permuted = BitDiddlePermutation(pdelta).Tables()[0]
+      row = array.array("B", [0]*256)
+      for x in range(0, 256):
+        row[permuted[x]] = x
+      rows.append(row.tostring())
+    return BitDiddlePermutationIndex("".join(rows))
+  Build = staticmethod(Build)
+
+  def Load(path, verify=True):
+    """Memory-maps the index at path, building and saving it if absent.
+
+    Args:
+      path: The index file.
+      verify: Whether to check the file against INDEX_MD5.
+
+    Returns:
+      A BitDiddlePermutationIndex.
+
+    Raises:
+      IOError: the file exists but is not a valid index.
+    """
+    if not os.path.exists(path):
+      BitDiddlePermutationIndex.Build().Save(path)
+    source = open(path, "rb")
+    try:
+      size = os.fstat(source.fileno()).st_size
+      expected = (BitDiddlePermutationIndex.ROWS *
+                  BitDiddlePermutationIndex.ROW_SIZE)
+      if size != expected:
+        raise IOError("%s holds %s bytes, not %s" % (path, size, expected))
+      data = mmap.mmap(source.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+      source.close()
+    index = BitDiddlePermutationIndex(data)
+    if verify and not index.Verify():
+      raise IOError("%s is corrupt; delete it to rebuild" % path)
+    return index
+  Load = staticmethod(Load)
+
+  def Shared():
+    """Returns this process's index, loading DEFAULT_PATH on first use.
+
+    If the file cannot be written or mapped, the index is built in memory.
+    """
+    if BitDiddlePermutationIndex._shared is None:
+      try:
+        index = BitDiddlePermutationIndex.Load(
+            BitDiddlePermutationIndex.DEFAULT_PATH)
+      except (IOError, OSError), e:
+        print "Not using %s: %s" % (BitDiddlePermutationIndex.DEFAULT_PATH, e)
+        index = BitDiddlePermutationIndex.Build()
+      BitDiddlePermutationIndex._shared = index
+    return BitDiddlePermutationIndex._shared
+  Shared = staticmethod(Shared)
+
+  def Save(self, path):
+    """Writes the index to path, creating its directory if need be."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    BitDiddleUtil.WriteAtomically(path, self._data[:])
+
+  def Verify(self):
+    """Returns whether the index data matches INDEX_MD5."""
+    return (hashlib.md5(self._data[:]).hexdigest() ==
+            BitDiddlePermutationIndex.INDEX_MD5)
+
+  def Row(self, r):
+    """Returns row r as a 256-byte string."""
+    start = r * BitDiddlePermutationIndex.ROW_SIZE
+    return self._data[start:start + BitDiddlePermutationIndex.ROW_SIZE]
+
+  def Gather(self, r, table):
+    """Applies the r-th byte permutation to the inputs of a truth table.
+
+    Args:
+      r: The permutation's position in itertools.permutations order.
+      table: A 256-byte string holding an S' truth table.
+
+    Returns:
+      The derived truth table, as DeriveS computes it, in an array.
+    """
+    return array.array("B", self.Row(r).translate(table))
+
+
+class BitDiddleEncryptor(object):
+  """A Bitdael encryptor keyed with fixed p, s and round count.
+
+  Precomputes everything a round needs so that encrypting a block reduces to
+  a handful of table lookups per round: eight byte-indexed permutation
+  lookups (see BitDiddlePermutation) feeding four lookups into a 16-bit wide
+  substitution table that applies s to two bytes at once. Build one instance
+  per key and reuse it for every block.
+
+  S is not linear, so the substitution cannot be folded into the per-input
+  byte permutation tables themselves; the wide table is the fused step.
+  """
+
+  def __init__(self, p, s, rounds):
+    """Compiles the round function for a key.
+
+    Args:
+      p: A permutation array that maps old bit positions to new bit positions,
+          or a BitDiddlePermutation compiled from one.
+      s: A substitution array that maps old bytes to new bytes.
+      rounds: The number of rounds to perform.
+    """
+    if not isinstance(p, BitDiddlePermutation):
+      p = BitDiddlePermutation(p)
+    if len(p) != 64:
+      raise ValueError("Bitdael permutations cover exactly 64 bits.")
+    self.p = p
+    self.s = array.array("B", s)
+    self.rounds = rounds
+    self._tables = p.Tables()
+    self._wide_s = [(self.s[x >> 8] << 8) | self.s[x & 0xFF]
+                    for x in range(0, 1 << 16)]
+
+  def RoundFunction(self, half):
+    """Equivalent to Substitute(Permute(half, p), s)."""
+    t0, t1, t2, t3, t4, t5, t6, t7 = self._tables
+    wide_s = self._wide_s
+    permuted = (t0[half & 0xFF] | t1[(half >> 8) & 0xFF] |
+                t2[(half >> 16) & 0xFF] | t3[(half >> 24) & 0xFF] |
+                t4[(half >> 32) & 0xFF] | t5[(half >> 40) & 0xFF] |
+                t6[(half >> 48) & 0xFF] | t7[half >> 56])
+    return (wide_s[permuted & 0xFFFF] |
+            (wide_s[(permuted >> 16) & 0xFFFF] << 16) |
+            (wide_s[(permuted >> 32) & 0xFFFF] << 32) |
+            (wide_s[permuted >> 48] << 48))
+
+  def Encrypt(self, plaintext):
+    """Equivalent to BitDiddleUtil.EncryptLocally(plaintext, p, s, rounds).
+
+    Args:
+      plaintext: The 128-bit plaintext block.
+
+    Returns:
+      Returns the encrypted ciphertext.
+    """
+    t0, t1, t2, t3, t4, t5, t6, t7 = self._tables
+    wide_s = self._wide_s
+    left = plaintext >> 64
+    right = plaintext & 0xFFFFFFFFFFFFFFFF
+    for _ in range(0, self.rounds):
+      # Inlined copy of RoundFunction; the call overhead dominates otherwise.
+      permuted = (t0[right & 0xFF] | t1[(right >> 8) & 0xFF] |
+                  t2[(right >> 16) & 0xFF] | t3[(right >> 24) & 0xFF] |
+                  t4[(right >> 32) & 0xFF] | t5[(right >> 40) & 0xFF] |
+                  t6[(right >> 48) & 0xFF] | t7[right >> 56])
+      left, right = right, left ^ (
+          wide_s[permuted & 0xFFFF] |
+          (wide_s[(permuted >> 16) & 0xFFFF] << 16) |
+          (wide_s[(permuted >> 32) & 0xFFFF] << 32) |
+          (wide_s[permuted >> 48] << 48))
+    return (left << 64) | right
+
+  def EncryptMany(self, plaintexts):
+    """Encrypts each block of an iterable of plaintexts.
+
+    Args:
+      plaintexts: An iterable of 128-bit plaintext blocks.
+
+    Returns:
+      A list of the corresponding ciphertexts.
+    """
+    encrypt = self.Encrypt
+    return [encrypt(plaintext) for plaintext in plaintexts]
+
+
 class BitDiddleUtil(object):
   """Static utility methods used by BitDiddleModule and keymasters."""
 
+  def WriteAtomically(path, data):
+    """Writes a whole file so that readers see all of it or none of it.
+
+    The data goes to a temporary file, unique to this process so that
+    concurrent writers do not collide, which is renamed over path once it is
+    safely on disk.
+
+    Args:
+      path: The file to write.
+      data: The string to write to it.
+    """
+    temporary = "%s.%s.tmp" % (path, os.getpid())
+    out = open(temporary, "wb")
+    try:
+      out.write(data)
+      out.flush()
+      os.fsync(out.fileno())
+    finally:
+      out.close()
+    os.rename(temporary, path)
+  WriteAtomically = staticmethod(WriteAtomically)
+
   def ToBase16(num):
     """Converts a raw number into a hex value encoded as a string.
 
@@ -461,6 +2186,18 @@ class BitDiddleUtil(object):
     return -1
   GetNonZeroByte = staticmethod(GetNonZeroByte)
 
+  def RepeatByte(value):
+    """Repeats a byte across a 64-bit number, e.g. 0xAB -> 0xABAB...AB.
+
+    Args:
+      value: The byte to repeat.
+
+    Returns:
+      The 64-bit repeated pattern.
+    """
+    return value * 0x0101010101010101
+  RepeatByte = staticmethod(RepeatByte)
+
   def ShiftIfThreeRounds(value, rounds):
     """Shifts the input 64-bit number by 64 bits if rounds = 3.
 
@@ -485,7 +2222,8 @@ class BitDiddleUtil(object):
 
     Args:
       plaintext: The 128-bit plaintext block.
-      p: A permutation array that maps old bit positions to new bit positions.
+      p: A permutation array that maps old bit positions to new bit positions,
+          or a BitDiddlePermutation compiled from one.
       s: A substitution array that maps old bytes to new bytes.
       rounds: The number of rounds to perform.
 
@@ -498,12 +2236,133 @@ class BitDiddleUtil(object):
     return result
   EncryptLocally = staticmethod(EncryptLocally)
 
+  def BlocksToArray(blocks):
+    """Packs 128-bit blocks into the array layout used by EncryptBatch.
+
+    Args:
+      blocks: An iterable of 128-bit integers.
+
+    Returns:
+      An (N, 2) uint64 NumPy array; column 0 holds the left (high) half and
+      column 1 the right (low) half of each block.
+    """
+    BitDiddleUtil.RequireNumpy()
+    return numpy.array([(block >> 64, block & 0xFFFFFFFFFFFFFFFF)
+                        for block in blocks],
+                       dtype=numpy.uint64).reshape(-1, 2)
+  BlocksToArray = staticmethod(BlocksToArray)
+
+  def ArrayToBlocks(arr):
+    """Unpacks an EncryptBatch array back into 128-bit integers.
+
+    Args:
+      arr: An (N, 2) uint64 or (N, 16) uint8 array of blocks.
+
+    Returns:
+      A list of the corresponding 128-bit integers.
+    """
+    halves = BitDiddleUtil._BatchHalves(arr)
+    return [(int(left) << 64) | int(right) for left, right in halves]
+  ArrayToBlocks = staticmethod(ArrayToBlocks)
+
+  def RequireNumpy():
+    """Raises ImportError if NumPy is unavailable."""
+    if numpy is None:
+      raise ImportError("Batch encryption requires NumPy.")
+  RequireNumpy = staticmethod(RequireNumpy)
+
+  def _BatchHalves(arr):
+    """Returns an (N, 2) uint64 copy of a batch in either supported layout.
+
+    (N, 16) uint8 arrays hold each block big-endian, so that byte 0 is the
+    leftmost byte of the block's hex encoding.
+    """
+    BitDiddleUtil.RequireNumpy()
+    arr = numpy.asarray(arr)
+    if arr.ndim == 2 and arr.shape[1] == 16 and arr.dtype == numpy.uint8:
+      return numpy.ascontiguousarray(arr).view(">u8").astype(numpy.uint64)
+    if arr.ndim == 2 and arr.shape[1] == 2:
+      return arr.astype(numpy.uint64)
+    raise ValueError("Expected an (N, 2) uint64 or (N, 16) uint8 array, "
+                     "got shape %s of %s." % (arr.shape, arr.dtype))
+  _BatchHalves = staticmethod(_BatchHalves)
+
+  def EncryptBatch(plaintexts, p, s, rounds):
+    """A vectorized implementation of the Bitdael algorithm.
+
+    Encrypts every block of a NumPy array at once, performing the permute,
+    substitute and Feistel swap of each round as whole-array operations.
+    Matches EncryptLocally block for block.
+
+    Args:
+      plaintexts: An (N, 2) uint64 array of (left, right) halves, or an
+          (N, 16) uint8 array of big-endian blocks.
+      p: A permutation array that maps old bit positions to new bit positions,
+          or a BitDiddlePermutation compiled from one.
+      s: A substitution array that maps old bytes to new bytes.
+      rounds: The number of rounds to perform.
+
+    Returns:
+      The ciphertexts, in the same layout as plaintexts.
+    """
+    halves = BitDiddleUtil._BatchHalves(plaintexts)
+    if not isinstance(p, BitDiddlePermutation):
+      p = BitDiddlePermutation(p)
+    left, right = BitDiddleUtil.EncryptHalves(
+        halves[:, 0], halves[:, 1], p.Tables(), s,
+        [(shift, 0xFF) for shift in range(0, 64, 8)], rounds)
+    result = numpy.column_stack((left, right))
+    if numpy.asarray(plaintexts).dtype == numpy.uint8:
+      return result.astype(">u8").view(numpy.uint8).reshape(-1, 16)
+    return result
+  EncryptBatch = staticmethod(EncryptBatch)
+
+  def EncryptHalves(left, right, p_tables, s_table, chunks, rounds):
+    """Runs Feistel rounds over arrays of halves at once with NumPy.
+
+    Args:
+      left: A uint64 array of left halves.
+      right: A uint64 array of right halves, of the same length.
+      p_tables: The byte-indexed tables of BitDiddlePermutation.Tables.
+      s_table: The substitution table, applied to each chunk of the permuted
+          half.
+      chunks: (shift, mask) of each chunk; the chunk at shift is the
+          permuted half's bits under mask << shift.
+      rounds: The number of rounds to perform.
+
+    Returns:
+      The (left, right) uint64 arrays after the last round.
+    """
+    p_tables = numpy.array(p_tables, dtype=numpy.uint64)
+    s_table = numpy.array(s_table, dtype=numpy.uint64)
+    # Keep every operand uint64; mixing in Python ints promotes to float64.
+    byte_mask = numpy.uint64(0xFF)
+    byte_shifts = [numpy.uint64(shift)
+                   for shift in range(0, 8 * len(p_tables), 8)]
+    chunks = [(numpy.uint64(shift), numpy.uint64(mask))
+              for shift, mask in chunks]
+
+    left = numpy.asarray(left, dtype=numpy.uint64)
+    right = numpy.asarray(right, dtype=numpy.uint64)
+    for _ in range(0, rounds):
+      permuted = numpy.zeros_like(right)
+      for table, shift in zip(p_tables, byte_shifts):
+        permuted |= table[((right >> shift) & byte_mask).astype(numpy.intp)]
+      substituted = numpy.zeros_like(right)
+      for shift, mask in chunks:
+        substituted |= (s_table[((permuted >> shift) & mask).astype(
+            numpy.intp)] & mask) << shift
+      left, right = right, left ^ substituted
+    return left, right
+  EncryptHalves = staticmethod(EncryptHalves)
+
   def Round(old_block, p, s):
     """Performs a single round of Bitdael.
 
     Args:
       old_block: The old block from the previous round/input.
-      p: A permutation array that maps old bit positions to new bit positions.
+      p: A permutation array that maps old bit positions to new bit positions,
+          or a BitDiddlePermutation compiled from one.
       s: A substitution array that maps old bytes to new bytes.
 
     Returns:
@@ -524,11 +2383,14 @@ class BitDiddleUtil(object):
 
     Args:
       half: The bits we would like to permute.
-      p: A permutation array that maps old bit positions to new bit positions.
+      p: A permutation array that maps old bit positions to new bit positions,
+          or a BitDiddlePermutation compiled from one.
 
     Returns:
       Returns the permuted number.
     """
+    if isinstance(p, BitDiddlePermutation):
+      return p.Permute(half)
     scrambled = 0
     for bit in range(0, len(p)):
       scrambled |= (half & 1) << p[bit]
@@ -541,14 +2403,21 @@ class BitDiddleUtil(object):
 
     Args:
       half: The bits we would like to have produced following a Permute round.
-      p: A permutation array that maps old bit positions to new bit positions.
+      p: A permutation array that maps old bit positions to new bit positions,
+          or a BitDiddlePermutation compiled from one.
 
     Returns:
       Returns the appropriate input required to produce the provided output.
     """
+    if isinstance(p, BitDiddlePermutation):
+      return p.Unpermute(half)
+    # Invert p once up front rather than calling p.index() for every bit.
+    inverse = [0]*len(p)
+    for bit in range(0, len(p)):
+      inverse[p[bit]] = bit
     scrambled = 0
     for bit in range(0, len(p)):
-      scrambled |= (half & 1) << p.index(bit)
+      scrambled |= (half & 1) << inverse[bit]
       half >>= 1
     return scrambled
   Unpermute = staticmethod(Unpermute)
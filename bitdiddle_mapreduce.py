@@ -0,0 +1,112 @@
+#!/usr/bin/python2.6
+# Copyright 2011 Google Inc. All Rights Reserved.
+# Author: Liz Fong (lizf@google.com/lizfong@mit.edu)
+
+"""Runs the Bitdael permutation enumeration as a local MapReduce job.
+
+This is the runnable form of bitdiddle_mapreduce_pseudocode: each map input
+names one byte position (and optionally a range of its permutations), the
+mappers run BitDiddleModule.Map, and the reducers run BitDiddleModule.Reduce
+over every derived S table that was shuffled to them.
+"""
+
+import cPickle
+
+import bitdiddle_lib
+import mapreduce_lib
+
+
+class BitDiddleMRMapper(mapreduce_lib.Mapper):
+  """Maps a byte position to its derived S tables.
+
+  Input keys have the form "i" or "i:start:stop". The job params supply the
+  S' truth tables and, optionally, the set of shuffle keys worth emitting.
+  """
+
+  def Map(self, map_input):
+    fields = [int(field) for field in map_input.key().split(":")]
+    i = fields[0]
+    start, stop = (fields[1:] + [0, None])[0:2]
+    keys = self.params.get("keys")
+    generator = bitdiddle_lib.BitDiddleModule.Map(
+        self.params["outputs"], i, start, stop)
+    for key, value in generator:
+      shuffle_key = bitdiddle_lib.BitDiddleModule.ShuffleKey(key)
+      if keys is None or shuffle_key in keys:
+        yield shuffle_key, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+
+class BitDiddleMRCombiner(mapreduce_lib.Combiner):
+  """Keeps only the first value per byte position for each key.
+
+  Reduce only ever uses one permutation per byte position, so the rest need
+  not be shuffled.
+  """
+
+  def Combine(self, key, values):
+    seen = set()
+    for value in values:
+      i = cPickle.loads(value)[0]
+      if i not in seen:
+        seen.add(i)
+        yield value
+
+
+class BitDiddleMRReducer(mapreduce_lib.Reducer):
+  """Reduces a shuffle key to a pickled (final_p, s_key), if one exists."""
+
+  def Reduce(self, reduce_input):
+    module = bitdiddle_lib.BitDiddleModule
+    values = [cPickle.loads(x) for x in reduce_input.values()]
+    s_key, values = module.VerifyShuffle(self.params["outputs"], values)
+    result = module.Reduce(s_key, values, self.params["p"])
+    if result is not None:
+      yield cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+
+
+def RunMapReduce(module, num_map_workers=None, num_reduce_workers=None,
+                 shards_per_byte=1, seeded=True, work_dir=None):
+  """Cracks Bitdael, enumerating the permutations with LocalMapReduce.
+
+  Args:
+    module: The BitDiddleModule to crack with. Its p_guess and s_guess are
+        set from the result and checked against its keymaster.
+    num_map_workers: Processes running map tasks; defaults to CPU count.
+    num_reduce_workers: Processes running reduce tasks; defaults to CPU count.
+    shards_per_byte: How many permutation ranges to split each byte into.
+    seeded: Whether mappers only emit keys matching a single byte 0 table;
+        see BitDiddleModule.EnumerateSerially for why this loses nothing.
+        Otherwise every derived table is shuffled.
+    work_dir: Directory for the shuffle files; a temporary one if not given.
+
+  Returns:
+    The (final_p, s_key) pair found, or None.
+  """
+  p_initial, outputs = module.GuessOutputs()
+  params = {"outputs": [list(table) for table in outputs],
+            "p": p_initial}
+  if seeded:
+    key, _ = bitdiddle_lib.BitDiddleModule.Map(outputs, 0).next()
+    params["keys"] = frozenset(
+        [bitdiddle_lib.BitDiddleModule.ShuffleKey(key)])
+
+  total = bitdiddle_lib.BitDiddleModule.PERMUTATION_COUNT
+  bounds = [total * n / shards_per_byte for n in range(0, shards_per_byte + 1)]
+  inputs = [("%s:%s:%s" % (i, bounds[n], bounds[n + 1]), "")
+            for i in range(0, 8) for n in range(0, shards_per_byte)]
+
+  job = mapreduce_lib.LocalMapReduce(
+      BitDiddleMRMapper, BitDiddleMRReducer,
+      combiner_class=BitDiddleMRCombiner, params=params,
+      num_map_workers=num_map_workers, num_reduce_workers=num_reduce_workers,
+      work_dir=work_dir)
+  results = job.Run(inputs)
+  if not results:
+    return None
+  module.AcceptCandidate(*cPickle.loads(results[0]))
+  module.Submit()
+  return module.p_guess, module.s_guess
+
+
+if __name__ == "__main__":
+  RunMapReduce(bitdiddle_lib.BitDiddleModule())
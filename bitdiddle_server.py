@@ -0,0 +1,129 @@
+#!/usr/bin/python2.6
+# Copyright 2011 Google Inc. All Rights Reserved.
+# Author: Liz Fong (lizf@google.com/lizfong@mit.edu)
+
+"""A local stand-in for the 6.857 Bitdael keymaster web service.
+
+Serves the genkey, encrypt and guess endpoints that BitDiddleRemoteKeyMaster
+talks to, backed by BitDiddleLocalKeyMaster keys, over HTTP/1.1 keep-alive.
+Useful for exercising the remote code path without touching the real server.
+"""
+
+import array
+import BaseHTTPServer
+import cgi
+import random
+import SocketServer
+import threading
+import urlparse
+
+import bitdiddle_lib
+
+
+class BitDiddleKeyMasterHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers keymaster requests from the server's keys."""
+
+  protocol_version = "HTTP/1.1"
+  # Send each response in one write, or keep-alive clients stall on Nagle.
+  wbufsize = -1
+
+  def do_GET(self):  # pylint: disable-msg=C6409
+    parts = urlparse.urlsplit(self.path)
+    query = dict((name, values[0])
+                 for name, values in cgi.parse_qs(parts[3]).items())
+    handler = {
+        "/ps2/genkey": self.server.GenKey,
+        "/ps2/encrypt": self.server.Encrypt,
+        "/ps2/guess": self.server.CheckGuess,
+        }.get(parts[2])
+    if handler is None:
+      self.send_error(404)
+      return
+    try:
+      body = handler(query) + "\n"
+    except (KeyError, ValueError), e:
+      self.send_error(400, str(e))
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *unused_args):  # pylint: disable-msg=C6409
+    pass
+
+
+class BitDiddleKeyMasterServer(SocketServer.ThreadingMixIn,
+                               BaseHTTPServer.HTTPServer):
+  """A threaded HTTP server holding any number of local Bitdael keys."""
+
+  daemon_threads = True
+
+  def __init__(self, port=0):
+    BaseHTTPServer.HTTPServer.__init__(
+        self, ("127.0.0.1", port), BitDiddleKeyMasterHandler)
+    self.keys = []
+    self.encrypt_count = 0
+    self._lock = threading.Lock()
+
+  def GenKey(self, query):
+    keymaster = bitdiddle_lib.BitDiddleLocalKeyMaster(
+        int(query["rounds"]), False)
+    self._lock.acquire()
+    try:
+      self.keys.append(keymaster)
+      key_number = len(self.keys) - 1
+    finally:
+      self._lock.release()
+    return "Your key number is <b>%s</b>" % key_number
+
+  def Encrypt(self, query):
+    keymaster = self.keys[int(query["key"])]
+    self._lock.acquire()
+    try:
+      self.encrypt_count += 1
+    finally:
+      self._lock.release()
+    return keymaster.CallKeymaster(query["data"])
+
+  def CheckGuess(self, query):
+    """Accepts a guess if it encrypts like the key on random blocks."""
+    keymaster = self.keys[int(query["key"])]
+    # Undo the bit ordering BitDiddleRemoteKeyMaster.Guess submits p in.
+    final_p = [int(query["p"][n:n + 2], 16) for n in range(0, 128, 2)]
+    p = array.array("B", [0]*64)
+    for i in range(0, 64):
+      p[63 - final_p[63 - i]] = i
+    s = array.array("B", [int(query["S"][n:n + 2], 16)
+                          for n in range(0, 512, 2)])
+    guess = bitdiddle_lib.BitDiddleEncryptor(p, s, keymaster.rounds)
+    for _ in range(0, 256):
+      plaintext = random.randint(0, 2 ** 128 - 1)
+      if guess.Encrypt(plaintext) != keymaster._encryptor.Encrypt(plaintext):
+        return "Incorrect guess."
+    return "Correct guess."
+
+  def Start(self):
+    """Serves requests on a daemon thread; returns the bound port."""
+    thread = threading.Thread(target=self.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return self.server_address[1]
+
+  def KeyMasterClass(self):
+    """Returns a BitDiddleRemoteKeyMaster subclass that talks to this server."""
+    base = "http://127.0.0.1:%s/ps2" % self.server_address[1]
+
+    class LocalRemoteKeyMaster(bitdiddle_lib.BitDiddleRemoteKeyMaster):
+      GENKEY_URL = base + "/genkey?team=%s&rounds=%s"
+      ENC_URL = base + "/encrypt?key=%s&data=%s"
+      GUESS_URL = base + "/guess?key=%s&p=%s&S=%s"
+
+    return LocalRemoteKeyMaster
+
+
+if __name__ == "__main__":
+  server = BitDiddleKeyMasterServer(8857)
+  print "Serving on port %s" % server.server_address[1]
+  server.serve_forever()
@@ -0,0 +1,284 @@
+#!/usr/bin/python2.6
+# Copyright 2011 Google Inc. All Rights Reserved.
+# Author: Liz Fong (lizf@google.com/lizfong@mit.edu)
+
+"""A small self-contained MapReduce runner for a single machine.
+
+Jobs are written against the same Mapper/Reducer interface used by
+bitdiddle_mapreduce_pseudocode: a mapper yields (key, value) string pairs
+for each input record, and a reducer yields output strings for each key
+together with all values emitted for it. Map output is partitioned by key
+into files under a working directory, so the shuffle does not have to fit
+in memory, and both phases run in pools of worker processes.
+"""
+
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+
+class MapInput(object):
+  """A single input record handed to Mapper.Map."""
+
+  def __init__(self, key, value):
+    self._key = key
+    self._value = value
+
+  def key(self):  # pylint: disable-msg=C6409
+    return self._key
+
+  def value(self):  # pylint: disable-msg=C6409
+    return self._value
+
+
+class ReduceInput(object):
+  """A key and all of its shuffled values, handed to Reducer.Reduce."""
+
+  def __init__(self, key, values):
+    self._key = key
+    self._values = values
+
+  def key(self):  # pylint: disable-msg=C6409
+    return self._key
+
+  def values(self):  # pylint: disable-msg=C6409
+    return iter(self._values)
+
+
+class Mapper(object):
+  """Base class for mappers.
+
+  Mappers are constructed once per map task, in the worker process, with the
+  job's params.
+  """
+
+  def __init__(self, params):
+    self.params = params
+
+  def Map(self, map_input):
+    """Yields (key, value) string pairs for a MapInput."""
+    raise NotImplementedError
+
+
+class Combiner(object):
+  """Base class for combiners.
+
+  A combiner runs inside each map task over the values that task emitted for
+  a key, and yields the (usually fewer) values to shuffle in their place.
+  """
+
+  def __init__(self, params):
+    self.params = params
+
+  def Combine(self, key, values):
+    """Yields the combined values for key."""
+    raise NotImplementedError
+
+
+class Reducer(object):
+  """Base class for reducers.
+
+  Reducers are constructed once per partition, in the worker process, with
+  the job's params.
+  """
+
+  def __init__(self, params):
+    self.params = params
+
+  def Reduce(self, reduce_input):
+    """Yields output strings for a ReduceInput."""
+    raise NotImplementedError
+
+
+class RecordFile(object):
+  """Reads and writes length-prefixed (key, value) string records."""
+
+  HEADER = struct.Struct(">II")
+
+  def Write(out, key, value):
+    """Appends one record to the open file out."""
+    out.write(RecordFile.HEADER.pack(len(key), len(value)))
+    out.write(key)
+    out.write(value)
+  Write = staticmethod(Write)
+
+  def Read(path):
+    """Yields each (key, value) record stored in the file at path."""
+    header = RecordFile.HEADER
+    source = open(path, "rb")
+    try:
+      while True:
+        raw = source.read(header.size)
+        if not raw:
+          return
+        if len(raw) < header.size:
+          raise IOError("Truncated record header in %s" % path)
+        key_length, value_length = header.unpack(raw)
+        key = source.read(key_length)
+        value = source.read(value_length)
+        if len(key) != key_length or len(value) != value_length:
+          raise IOError("Truncated record in %s" % path)
+        yield key, value
+    finally:
+      source.close()
+  Read = staticmethod(Read)
+
+
+class LocalMapReduce(object):
+  """Runs a MapReduce job with local worker processes.
+
+  Each input record is one map task. Map tasks write their output into one
+  file per reduce partition, choosing the partition from a CRC of the key;
+  combiners, if any, run over each task's buffered output before it is
+  written. Each partition is then reduced by one reduce task.
+  """
+
+  def __init__(self, mapper_class, reducer_class, combiner_class=None,
+               params=None, num_map_workers=None, num_reduce_workers=None,
+               num_partitions=None, combine_buffer=100000, work_dir=None):
+    """Configures a job.
+
+    Args:
+      mapper_class: A Mapper subclass.
+      reducer_class: A Reducer subclass.
+      combiner_class: An optional Combiner subclass.
+      params: A picklable object passed to every mapper, combiner and reducer.
+      num_map_workers: Processes running map tasks; defaults to CPU count.
+      num_reduce_workers: Processes running reduce tasks; defaults to CPU
+          count.
+      num_partitions: Number of reduce partitions; defaults to
+          num_reduce_workers, or the CPU count.
+      combine_buffer: How many map outputs a task buffers before combining and
+          writing them out. Only used with a combiner.
+      work_dir: Directory for the partitioned shuffle files. A temporary
+          directory is created (and removed afterwards) if not given.
+    """
+    self.mapper_class = mapper_class
+    self.reducer_class = reducer_class
+    self.combiner_class = combiner_class
+    self.params = params
+    self.num_map_workers = num_map_workers or multiprocessing.cpu_count()
+    self.num_reduce_workers = (num_reduce_workers or
+                               multiprocessing.cpu_count())
+    self.num_partitions = num_partitions or self.num_reduce_workers
+    self.combine_buffer = combine_buffer
+    self.work_dir = work_dir
+
+  def Run(self, inputs):
+    """Runs the job.
+
+    Args:
+      inputs: A sequence of (key, value) input records.
+
+    Returns:
+      A list of every string yielded by the reducers, in partition order and
+      then key order within each partition.
+    """
+    work_dir = self.work_dir or tempfile.mkdtemp(prefix="mapreduce-")
+    try:
+      map_tasks = [(self, work_dir, task, key, value)
+                   for task, (key, value) in enumerate(inputs)]
+      self._RunPool(_RunMapTask, map_tasks, self.num_map_workers)
+      reduce_tasks = [(self, work_dir, len(map_tasks), partition)
+                      for partition in range(0, self.num_partitions)]
+      outputs = []
+      for partition_output in self._RunPool(_RunReduceTask, reduce_tasks,
+                                            self.num_reduce_workers):
+        outputs.extend(partition_output)
+      return outputs
+    finally:
+      if self.work_dir is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+  def Partition(self, key):
+    """Returns the reduce partition for a key."""
+    return (zlib.crc32(key) & 0xFFFFFFFF) % self.num_partitions
+
+  def PartitionPath(work_dir, task, partition):
+    """Returns the path of one map task's output for one partition."""
+    return os.path.join(work_dir, "map-%05d-part-%05d" % (task, partition))
+  PartitionPath = staticmethod(PartitionPath)
+
+  def _RunPool(function, tasks, workers):
+    """Runs function over tasks, in-process if only one worker is wanted."""
+    if workers == 1:
+      return [function(task) for task in tasks]
+    pool = multiprocessing.Pool(workers)
+    try:
+      return pool.map(function, tasks)
+    finally:
+      pool.close()
+      pool.join()
+  _RunPool = staticmethod(_RunPool)
+
+  def MapTask(self, work_dir, task, key, value):
+    """Runs the mapper over one input record and writes its partitions."""
+    mapper = self.mapper_class(self.params)
+    combiner = None
+    if self.combiner_class is not None:
+      combiner = self.combiner_class(self.params)
+    outs = [open(LocalMapReduce.PartitionPath(work_dir, task, partition), "wb")
+            for partition in range(0, self.num_partitions)]
+    try:
+      buffered = dict()
+      count = 0
+      for out_key, out_value in mapper.Map(MapInput(key, value)):
+        if combiner is None:
+          RecordFile.Write(outs[self.Partition(out_key)], out_key, out_value)
+          continue
+        try:
+          buffered[out_key].append(out_value)
+        except KeyError:
+          buffered[out_key] = [out_value]
+        count += 1
+        if count >= self.combine_buffer:
+          self._FlushCombined(combiner, buffered, outs)
+          buffered = dict()
+          count = 0
+      if combiner is not None:
+        self._FlushCombined(combiner, buffered, outs)
+    finally:
+      for out in outs:
+        out.close()
+
+  def _FlushCombined(self, combiner, buffered, outs):
+    """Combines buffered map output and writes it to the partition files."""
+    for out_key, values in buffered.iteritems():
+      out = outs[self.Partition(out_key)]
+      for out_value in combiner.Combine(out_key, values):
+        RecordFile.Write(out, out_key, out_value)
+
+  def ReduceTask(self, work_dir, num_map_tasks, partition):
+    """Shuffles and reduces one partition.
+
+    Returns:
+      A list of the strings the reducer yielded.
+    """
+    grouped = dict()
+    for task in range(0, num_map_tasks):
+      path = LocalMapReduce.PartitionPath(work_dir, task, partition)
+      for key, value in RecordFile.Read(path):
+        try:
+          grouped[key].append(value)
+        except KeyError:
+          grouped[key] = [value]
+    reducer = self.reducer_class(self.params)
+    outputs = []
+    for key in sorted(grouped):
+      outputs.extend(reducer.Reduce(ReduceInput(key, grouped[key])))
+    return outputs
+
+
+def _RunMapTask(task):
+  """Entry point for map tasks in worker processes."""
+  job, work_dir, task_number, key, value = task
+  job.MapTask(work_dir, task_number, key, value)
+
+
+def _RunReduceTask(task):
+  """Entry point for reduce tasks in worker processes."""
+  job, work_dir, num_map_tasks, partition = task
+  return job.ReduceTask(work_dir, num_map_tasks, partition)
@@ -2,11 +2,24 @@
 import sys
 import array
 
+import rc4_data
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Bytes regenerated and compared at a time by check_solution.
+CHUNK = 1 << 16
+
 
 class Rc4Solver:
-    def __init__(self):
+    def __init__(self, trace=False):
         self.i = self.j = self.ij = self.out = self.leak = self.state_swap = 0;
-        self.state = self.initializeState();        
+        self.trace = trace;
+        self.state = self.initializeState();
+        # Number of state cells still -1, so solved_state needn't scan.
+        self.unknown = len(self.state);
 
     def initializeState(self):
         rc_state = array.array('i');
@@ -14,69 +27,104 @@ class Rc4Solver:
             rc_state.append(-1);
         return rc_state;
 
+    def set_state(self, index, value):
+        if (self.state[index] == -1):
+            self.unknown -= 1;
+        self.state[index] = value;
+
     def swap_state(self,i,j):
         self.state_swap = self.state[i];
         self.state[i] = self.state[j];
         self.state[j] = self.state_swap;
 
     def solved_state(self):
-        for w in range(len(self.state)):
-            if (self.state[w] == -1):
-                return False;
-        return True;
+        return self.unknown == 0;
 
-    def check_round(self, out_byte, leak_byte):
-        self.i = (self.i + 1) % 256;
-        self.j = (self.j + self.state[self.i]) % 256;
-        self.swap_state(self.i,self.j);
-        self.out = self.state[(self.state[self.i]+self.state[self.j])%256];
-        if (self.out != int(ord(out_byte))):
-            print "Not a match";
-        #print "expected: " + str(int(ord(out_byte))) + " actual: " + str(self.out);
-        #print (self.out == int(ord(out_byte)));
-        #print "expected: " + str(int(ord(leak_byte))) + " actual: " + str(self.j);
-        
-    def check_solution(self, leak_bytes, out_bytes, w):
+    def check_solution(self, capture, w):
+        # Runs the recovered state forward over the rest of the capture a
+        # chunk at a time, regenerating the leaked j and output bytes, and
+        # compares each chunk with the files in one go. Returns the number of
+        # mismatched bytes.
         print "\nChecking solution...";
-        for w in range(w, len(out_bytes)):
-            self.check_round(out_bytes[w], leak_bytes[w]);
+        S = self.state;
+        i = self.i;
+        j = self.j;
+        mismatches = 0;
+        for start in xrange(w, len(capture), CHUNK):
+            size = min(CHUNK, len(capture) - start);
+            jbits = bytearray(size);
+            stream = bytearray(size);
+            for n in xrange(size):
+                i = (i + 1) & 255;
+                Si = S[i];
+                j = (j + Si) & 255;
+                Sj = S[j];
+                S[i] = Sj;
+                S[j] = Si;
+                jbits[n] = j;
+                stream[n] = S[(Si + Sj) & 255];
+            (leak_bytes, out_bytes) = capture.read(start, start + size);
+            mismatches += self.count_mismatches(stream, out_bytes);
+            mismatches += self.count_mismatches(jbits, leak_bytes);
+        self.i = i;
+        self.j = j;
+        if (mismatches):
+            print "Not a match: " + str(mismatches) + " bytes differ";
+        else:
+            print "Solution matches all " + str(len(capture)) + " bytes";
+        return mismatches;
+
+    def count_mismatches(self, mine, expected):
+        if (mine == expected):
+            return 0;
+        if (numpy is not None):
+            return int(numpy.count_nonzero(
+                numpy.frombuffer(mine, dtype=numpy.uint8) !=
+                numpy.frombuffer(expected, dtype=numpy.uint8)));
+        return len([n for n in xrange(len(mine))
+                    if mine[n] != expected[n]]);
 
     def decrypt_round(self, out_byte, leak_byte):
-        self.out = int(ord(out_byte));
-        self.leak = int(ord(leak_byte));
+        self.out = out_byte;
+        self.leak = leak_byte;
         self.i = (self.i + 1) % 256;
-        self.state[self.i] = (self.leak - self.j) % 256;
+        self.set_state(self.i, (self.leak - self.j) % 256);
         self.j = self.leak;
         self.swap_state(self.i,self.j);
         if (self.state[self.i] > -1 and self.state[self.j] > -1):
             self.ij = (self.state[self.i] + self.state[self.j]) % 256;
-            self.state[self.ij] = self.out;
-        print str(self.i).zfill(3) + " | " + str(self.j).zfill(3) + " | " + str(self.out).zfill(3) + " | " + str(self.state[self.j]).zfill(3);
+            self.set_state(self.ij, self.out);
+        if (self.trace):
+            print str(self.i).zfill(3) + " | " + str(self.j).zfill(3) + " | " + str(self.out).zfill(3) + " | " + str(self.state[self.j]).zfill(3);
 
 
     def decrypt(self, leak_file, output_file, rounds):
-        leak = open(leak_file, 'r');
-        output = open(output_file, 'r');
-        leak_bytes = leak.read();
-        out_bytes = output.read();
-        
-        print '\n i     j    out  S[j]\n';
-        for w in range(rounds):            
+        # The files are mapped, not read; only the rounds used are copied out.
+        capture = rc4_data.Capture(leak_file, output_file);
+        (leak_bytes, out_bytes) = capture.read(0, rounds);
+
+        if (self.trace):
+            print '\n i     j    out  S[j]\n';
+        for w in range(len(out_bytes)):
             self.decrypt_round(out_bytes[w], leak_bytes[w]);
             if (self.solved_state()):
                 w = w + 1;
                 break;
-        
+
         print "\n" + str(self.state);
+        if (not self.solved_state()):
+            # Running an incomplete state forward would index with -1 cells.
+            print "\nState still unsolved after " + str(len(out_bytes)) + " rounds";
+            return len(capture);
         print "\nnumber of rounds to solve state: " + str(w) + "\n";
-        self.check_solution(leak_bytes, out_bytes, w);
+        return self.check_solution(capture, w);
 
     def run(self):
         leak_file = 'jbits8.dat';
         output_file = 'stream8.dat';
         num_rounds = 1000;
-        self.decrypt(leak_file, output_file, num_rounds);
-        
+        return self.decrypt(leak_file, output_file, num_rounds);
+
 
 if __name__ == '__main__':
-    Rc4Solver().run();
+    Rc4Solver(trace='-v' in sys.argv[1:]).run();
@@ -1,31 +1,99 @@
 #!/usr/bin/env python
 
-import secrets
+import multiprocessing
 
-def rc4(key, k, l):
-    jbits = ""
-    stream = ""
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-    mask = (2**k - 1) << (8 - k)
+# Bytes generated per chunk when streaming to files.
+CHUNK = 1 << 16
 
-    i = j = 0
+def schedule(key):
+    # RC4 key scheduling; returns the initial permutation S.
     S = range(256)
+    j = 0
     for i in xrange(256):
-        j = (j + S[i] + ord(key[i % len(key)])) % 256
+        j = (j + S[i] + ord(key[i % len(key)])) & 255
         (S[i], S[j]) = (S[j], S[i])
+    return S
 
+def rc4_chunks(key, k, l, chunk=CHUNK, use_numpy=True):
+    # Yields (jbits, stream) bytearrays of at most chunk bytes each, l bytes
+    # in all; concatenated they equal rc4(key, k, l).
+    return state_chunks(schedule(key), k, l, chunk, use_numpy)
+
+def state_chunks(S, k, l, chunk=CHUNK, use_numpy=True):
+    # Like rc4_chunks, but runs from the permutation S (which is left as is)
+    # rather than a key. Each chunk is written into preallocated buffers
+    # rather than grown a character at a time.
+    mask = (2**k - 1) << (8 - k)
+    vectorize = use_numpy and numpy is not None
+    S = list(S)
     i = j = 0
-    for n in xrange(l):
-        i = (i + 1) % 256
-        j = (j + S[i]) % 256
-        (S[i], S[j]) = (S[j], S[i])
-        jbits += chr(j & mask)
-        stream += chr(S[(S[i] + S[j]) % 256])
+    done = 0
+    while done < l:
+        size = min(chunk, l - done)
+        jbits = bytearray(size)
+        stream = bytearray(size)
+        for n in xrange(size):
+            i = (i + 1) & 255
+            Si = S[i]
+            j = (j + Si) & 255
+            Sj = S[j]
+            S[i] = Sj
+            S[j] = Si
+            jbits[n] = j
+            stream[n] = S[(Si + Sj) & 255]
+        # Masking is a separate pass, so it can be done on the whole chunk at
+        # once.
+        if vectorize:
+            raw = numpy.frombuffer(jbits, dtype=numpy.uint8)
+            jbits = bytearray((raw & mask).tostring())
+        elif mask != 255:
+            for n in xrange(size):
+                jbits[n] &= mask
+        done += size
+        yield (jbits, stream)
+
+def rc4(key, k, l):
+    jbits = bytearray()
+    stream = bytearray()
+    for (jbits_chunk, stream_chunk) in rc4_chunks(key, k, l):
+        jbits += jbits_chunk
+        stream += stream_chunk
+    return (str(jbits), str(stream))
+
+def write_files(key, k, l, jbits_path=None, stream_path=None, chunk=CHUNK):
+    # Streams rc4(key, k, l) to jbits<k>.dat and stream<k>.dat, or the given
+    # paths, a chunk at a time.
+    jbits_out = open(jbits_path or "jbits%d.dat" % k, "wb")
+    stream_out = open(stream_path or "stream%d.dat" % k, "wb")
+    try:
+        for (jbits, stream) in rc4_chunks(key, k, l, chunk):
+            jbits_out.write(jbits)
+            stream_out.write(stream)
+    finally:
+        jbits_out.close()
+        stream_out.close()
+
+def _write_files(args):
+    write_files(*args)
 
-    return (jbits, stream)
+def write_all(keys, l, processes=None):
+    # Generates the files for every key, key n using k = n + 1, in parallel.
+    tasks = [(keys[n], n + 1, l) for n in xrange(len(keys))]
+    if processes == 1:
+        map(_write_files, tasks)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        pool.map(_write_files, tasks)
+    finally:
+        pool.close()
+        pool.join()
 
 if __name__ == '__main__':
-    for k in xrange(8):
-        (jbits, stream) = rc4(secrets.secrets[k], k+1, 2**20)
-        open("jbits%d.dat" % (k+1), "w").write(jbits)
-        open("stream%d.dat" % (k+1), "w").write(stream)
+    import secrets
+    write_all([secrets.secrets[k] for k in xrange(8)], 2**20)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# Read-only access to the jbitsK.dat/streamK.dat captures written by rc4.py.
+#
+# The files are memory-mapped rather than read in, so opening a capture takes
+# the same time whatever its size, pages are only read from disk once they are
+# touched, and processes opening the same capture share them. A window onto
+# part of a capture shares its maps. Bytes come out either without copying,
+# as buffers or NumPy arrays over the maps, or as bytearrays copied a slice at
+# a time for code that indexes them byte by byte.
+
+import mmap
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _map(path):
+    f = open(path, 'rb')
+    try:
+        # An empty file cannot be mapped, but an empty string reads the same.
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+class Capture(object):
+    # The leaked j bits and the keystream of one run, byte r of each coming
+    # from round r. offset and length select a window of the files.
+
+    def __init__(self, leak_path, stream_path, k=None, offset=0, length=None,
+                 maps=None):
+        self.leak_path = leak_path
+        self.stream_path = stream_path
+        self.k = k
+        if maps is None:
+            maps = (_map(leak_path), _map(stream_path))
+        (self.leak_map, self.stream_map) = maps
+        if len(self.leak_map) != len(self.stream_map):
+            raise ValueError("%s has %d bytes but %s has %d"
+                             % (leak_path, len(self.leak_map), stream_path,
+                                len(self.stream_map)))
+        if length is None:
+            length = len(self.leak_map) - offset
+        if offset < 0 or length < 0 or offset + length > len(self.leak_map):
+            raise ValueError("window [%d, %d) is outside the %d byte capture"
+                             % (offset, offset + length, len(self.leak_map)))
+        self.offset = offset
+        self.length = length
+
+    def open(cls, k, directory='.'):
+        # The capture rc4.write_files writes for k in directory.
+        return cls(os.path.join(directory, 'jbits%d.dat' % k),
+                   os.path.join(directory, 'stream%d.dat' % k), k)
+    open = classmethod(open)
+
+    def __len__(self):
+        return self.length
+
+    def __reduce__(self):
+        # Maps cannot be pickled, so a capture sent to another process maps
+        # the files again there.
+        return (Capture, (self.leak_path, self.stream_path, self.k,
+                          self.offset, self.length))
+
+    def window(self, offset, length=None):
+        # The bytes from offset for length bytes (to the end by default),
+        # relative to this window, sharing its maps.
+        if length is None:
+            length = self.length - offset
+        if offset < 0 or length < 0 or offset + length > self.length:
+            raise ValueError("window [%d, %d) is outside the %d byte window"
+                             % (offset, offset + length, self.length))
+        return Capture(self.leak_path, self.stream_path, self.k,
+                       self.offset + offset, length,
+                       (self.leak_map, self.stream_map))
+
+    def buffers(self):
+        # (leak, stream) as read-only buffers over the maps, without copying.
+        return (buffer(self.leak_map, self.offset, self.length),
+                buffer(self.stream_map, self.offset, self.length))
+
+    def arrays(self):
+        # (leak, stream) as read-only NumPy uint8 arrays over the maps, without
+        # copying.
+        if numpy is None:
+            raise ImportError("Capture.arrays needs NumPy")
+        return (numpy.frombuffer(self.leak_map, numpy.uint8, self.length,
+                                 self.offset),
+                numpy.frombuffer(self.stream_map, numpy.uint8, self.length,
+                                 self.offset))
+
+    def read(self, start=0, stop=None):
+        # Copies bytes [start, stop) of the window out as (leak, stream)
+        # bytearrays, whose items are ints.
+        if stop is None or stop > self.length:
+            stop = self.length
+        start = min(max(start, 0), stop)
+        return (bytearray(self.leak_map[self.offset + start:
+                                        self.offset + stop]),
+                bytearray(self.stream_map[self.offset + start:
+                                          self.offset + stop]))
+
+    def close(self):
+        # Unmaps the files, and so every window sharing them.
+        for m in (self.leak_map, self.stream_map):
+            if isinstance(m, mmap.mmap):
+                m.close()
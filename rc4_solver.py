@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# Recovers the RC4 state from a keystream and the top k bits of j leaked each
+# round (the jbitsK.dat/streamK.dat files written by rc4.py), for any k from 1
+# to 8.
+#
+# The unknowns are the values of the initial permutation S0. i and j both start
+# at 0, so under any one hypothesis about the values of S[i] taken along the
+# way every swap is a known transposition, and every cell of the current state
+# is a known cell of S0. Each round r then constrains S0 twice:
+#   leak: the top k bits of j + S[i] are jbits[r]
+#   out:  S[S[i] + S[j]] is stream[r]
+# The search goes a round at a time. When the S0 cell under S[i] has no value
+# yet it branches over the values the leak allows (exactly one for k = 8,
+# 2**(8-k) at most otherwise). Every value it sets is propagated through a
+# worklist: only the output constraints waiting on that cell or that value are
+# woken, and each of them sets one more value when it resolves. An output
+# constraint that cannot be resolved yet waits; a contradiction backtracks to
+# the most recent branch. Once all 256 values are known the state is run over
+# the whole capture to confirm it.
+#
+# With --parallel the same search is sharded across a process pool (see
+# solve_parallel), and with --checkpoint-dir it can be stopped and resumed.
+#
+# Only k = 8 solves in practice: it never branches and finishes in about 250
+# rounds. Every bit less multiplies the branching, and k <= 7 does not finish
+# in any reasonable time. So with no arguments only k = 8 is solved, and every
+# key gets up to --max-seconds (60 by default; 0 for no limit).
+
+import json
+import multiprocessing
+import optparse
+import os
+import Queue
+import sys
+import time
+
+import rc4
+import rc4_data
+
+# Nodes searched between checks of the time limit.
+CHECK_EVERY = 1024
+
+# Nodes a worker searches in one subtree before handing back the rest.
+CHUNK_NODES = 20000
+
+# Rounds of the capture the search may use. The state is known long before
+# this, so only the check of a solution reads further into the files.
+SEARCH_ROUNDS = 1 << 16
+
+
+class Frame(object):
+    # One round on the search path: the choices for the value of S[i] and
+    # what must be undone before trying the next one.
+
+    def __init__(self, r, j, choices, trail, waiting):
+        self.r = r
+        self.j = j
+        self.choices = choices
+        self.next = 0
+        self.trail = trail
+        self.waiting = waiting
+        # j after this round, once its swap has been done.
+        self.swapped = None
+
+
+class Rc4StateSolver(object):
+
+    def __init__(self, k, capture, max_nodes=None, max_seconds=None):
+        self.k = k
+        self.mask = ((1 << k) - 1) << (8 - k)
+        self.capture = capture
+        (self.leak, self.stream) = capture.read(0, SEARCH_ROUNDS)
+        self.max_nodes = max_nodes
+        self.max_seconds = max_seconds
+
+    def reset(self):
+        self.value = [-1] * 256      # S0 cell -> value, -1 if unknown
+        self.owner = [-1] * 256      # value -> S0 cell, -1 if unused
+        self.loc = range(256)        # current position -> S0 cell
+        self.known = 0
+        self.trail = []              # cells set, in order, for undoing
+        # Output constraints waiting on a value, as (cell, sj, out, loc): the
+        # S0 cell that was under S[i], the value of S[j], the stream byte and
+        # a snapshot of loc, all after that round's swap.
+        self.waiting = []
+        self.cell_watch = [[] for n in xrange(256)]
+        self.value_watch = [[] for n in xrange(256)]
+        self.nodes = 0
+        self.rounds = 0
+        # The most rounds any hypothesis has been played through.
+        self.deepest = 0
+
+    def assign(self, cell, value):
+        # Sets S0[cell] = value and propagates it. Returns False, leaving the
+        # caller to undo, if that contradicts what is already known.
+        queue = [(cell, value)]
+        while queue:
+            (cell, value) = queue.pop()
+            if self.value[cell] == value:
+                continue
+            if self.value[cell] != -1 or self.owner[value] != -1:
+                return False
+            self.value[cell] = value
+            self.owner[value] = cell
+            self.known += 1
+            self.trail.append(cell)
+            # S[i] is now known, so S[S[i] + S[j]] is a known cell.
+            for n in self.cell_watch[cell]:
+                (unused, sj, out, loc) = self.waiting[n]
+                queue.append((loc[(value + sj) & 255], out))
+            # The output byte has a known cell, so S[i] + S[j] is its position.
+            for n in self.value_watch[value]:
+                (si_cell, sj, out, loc) = self.waiting[n]
+                queue.append((si_cell, (loc.index(cell) - sj) & 255))
+        return True
+
+    def wait(self, cell, sj, out):
+        n = len(self.waiting)
+        self.waiting.append((cell, sj, out, tuple(self.loc)))
+        self.cell_watch[cell].append(n)
+        self.value_watch[out].append(n)
+
+    def undo(self, frame):
+        while len(self.trail) > frame.trail:
+            cell = self.trail.pop()
+            self.owner[self.value[cell]] = -1
+            self.value[cell] = -1
+            self.known -= 1
+        # Constraints are added and removed in stack order, so each is the
+        # last entry of its watch lists.
+        while len(self.waiting) > frame.waiting:
+            (cell, sj, out, loc) = self.waiting.pop()
+            self.cell_watch[cell].pop()
+            self.value_watch[out].pop()
+        if frame.swapped is not None:
+            i = (frame.r + 1) & 255
+            loc = self.loc
+            (loc[i], loc[frame.swapped]) = (loc[frame.swapped], loc[i])
+            frame.swapped = None
+
+    def frame(self, r, j):
+        # The values S[i] may take in round r, given j before it.
+        cell = self.loc[(r + 1) & 255]
+        if self.value[cell] != -1:
+            choices = [self.value[cell]]
+        else:
+            base = (self.leak[r] - j) & 255
+            choices = [(base + d) & 255 for d in xrange(256 >> self.k)
+                       if self.owner[(base + d) & 255] == -1]
+        return Frame(r, j, choices, len(self.trail), len(self.waiting))
+
+    def play(self, frame, si):
+        # Plays round frame.r with S[i] = si. Returns j after it, or -1 on a
+        # contradiction.
+        r = frame.r
+        i = (r + 1) & 255
+        loc = self.loc
+        if not self.assign(loc[i], si):
+            return -1
+        j = (frame.j + si) & 255
+        if (j & self.mask) != self.leak[r]:
+            return -1
+        (loc[i], loc[j]) = (loc[j], loc[i])
+        frame.swapped = j
+        # S[j] now holds si; the value of S[i], the old S[j], may be unknown.
+        out = self.stream[r]
+        cell = loc[i]
+        if self.value[cell] != -1:
+            ok = self.assign(loc[(self.value[cell] + si) & 255], out)
+        elif self.owner[out] != -1:
+            ok = self.assign(cell, (loc.index(self.owner[out]) - si) & 255)
+        else:
+            self.wait(cell, si, out)
+            ok = True
+        if not ok:
+            return -1
+        return j
+
+    def confirm(self):
+        # Whether the recovered S0 reproduces the whole capture.
+        done = 0
+        for (jbits, stream) in rc4.state_chunks(self.value, self.k,
+                                                len(self.capture)):
+            size = len(stream)
+            if (jbits, stream) != self.capture.read(done, done + size):
+                return False
+            done += size
+        return True
+
+    def solve(self):
+        # Returns the initial permutation, or None if the search ran out of
+        # data, nodes or time, or has no solution.
+        self.reset()
+        deadline = None
+        if self.max_seconds is not None:
+            deadline = time.time() + self.max_seconds
+        return self.search([self.frame(0, 0)], 0, self.max_nodes, deadline)
+
+    def replay(self, path):
+        # Plays the rounds with the values of S[i] given by path, from a fresh
+        # state. Returns the frames to search below it, or None if path is
+        # inconsistent.
+        self.reset()
+        frames = []
+        j = 0
+        for (r, si) in enumerate(path):
+            frame = self.frame(r, j)
+            frame.choices = [si]
+            frame.next = 1
+            j = self.play(frame, si)
+            if j < 0:
+                return None
+            frames.append(frame)
+        self.deepest = len(path)
+        if len(path) == len(self.stream):
+            return frames
+        return frames + [self.frame(len(path), j)]
+
+    def search(self, frames, floor, max_nodes=None, deadline=None):
+        # Depth-first search of the rounds below frames[floor - 1]. Returns
+        # the initial permutation if found. Otherwise returns None, leaving
+        # frames empty down to floor if that subtree is exhausted, or holding
+        # the unexplored rest of it if max_nodes or the deadline ran out.
+        limit = None
+        if max_nodes is not None:
+            limit = self.nodes + max_nodes
+        while len(frames) > floor:
+            frame = frames[-1]
+            self.undo(frame)
+            if frame.next == len(frame.choices):
+                frames.pop()
+                continue
+            if limit is not None and self.nodes >= limit:
+                return None
+            if (deadline is not None and self.nodes % CHECK_EVERY == 0 and
+                    time.time() > deadline):
+                return None
+            si = frame.choices[frame.next]
+            frame.next += 1
+            self.nodes += 1
+            j = self.play(frame, si)
+            if j < 0:
+                continue
+            self.deepest = max(self.deepest, frame.r + 1)
+            if self.known == 256:
+                if self.confirm():
+                    self.rounds = frame.r + 1
+                    return list(self.value)
+                continue
+            if frame.r + 1 == len(self.stream):
+                continue
+            frames.append(self.frame(frame.r + 1, j))
+        return None
+
+    def explore(self, path, max_nodes):
+        # Searches below path for at most max_nodes nodes. Returns (state,
+        # rest): the initial permutation or None, and the paths still to be
+        # searched, shallowest first.
+        frames = self.replay(path)
+        # The last round of path is this subtree's root, a node of its own.
+        self.nodes = min(len(path), 1)
+        if frames is None:
+            return (None, [])
+        if self.known == 256:
+            if self.confirm():
+                self.rounds = len(path)
+                return (list(self.value), [])
+            return (None, [])
+        floor = len(path)
+        state = self.search(frames, floor, max_nodes)
+        rest = []
+        for depth in xrange(floor, len(frames)):
+            taken = [frame.choices[frame.next - 1] for frame in frames[:depth]]
+            frame = frames[depth]
+            rest.extend([taken + [si] for si in frame.choices[frame.next:]])
+        return (state, rest)
+
+
+# The solver in each worker process of solve_parallel.
+_solver = None
+
+def _start_worker(k, capture):
+    global _solver
+    _solver = Rc4StateSolver(k, capture)
+
+def _explore(task):
+    # Returns (path, state, rest, nodes, deepest, rounds, error) for one
+    # subtree.
+    (path, max_nodes) = task
+    try:
+        (state, rest) = _solver.explore(path, max_nodes)
+    except Exception, e:
+        return (path, None, [], _solver.nodes, 0, 0, repr(e))
+    return (path, state, rest, _solver.nodes, _solver.deepest, _solver.rounds,
+            None)
+
+def save_frontier(path, k, nodes, frontier):
+    # Written under a temporary name and renamed into place, so an
+    # interrupted save leaves the previous checkpoint intact.
+    temporary = path + '.tmp'
+    out = open(temporary, 'w')
+    try:
+        json.dump({'k': k, 'nodes': nodes, 'frontier': frontier}, out)
+    finally:
+        out.close()
+    os.rename(temporary, path)
+
+def load_frontier(path, k):
+    # Returns (nodes, frontier) saved by save_frontier, or a fresh search if
+    # there is no checkpoint.
+    if path is None or not os.path.exists(path):
+        return (0, [[]])
+    saved = json.load(open(path))
+    if saved['k'] != k:
+        raise ValueError("%s is a checkpoint for k=%d, not k=%d"
+                         % (path, saved['k'], k))
+    return (saved['nodes'], saved['frontier'])
+
+def solve_parallel(k, capture, workers=None, max_seconds=None,
+                   checkpoint=None, checkpoint_seconds=60.0,
+                   chunk=CHUNK_NODES):
+    # Branch and bound across a process pool. The frontier is a stack of
+    # paths, each the values of S[i] for the rounds leading to an unexplored
+    # subtree. A worker searches a subtree for at most chunk nodes and hands
+    # back whatever it did not get to, so idle workers take over the
+    # unexplored branches of busy ones rather than waiting for them. The
+    # frontier, including the subtrees in flight, is saved to checkpoint every
+    # checkpoint_seconds and when time runs out, and a search resumes from it.
+    # Returns (state, rounds, nodes, deepest), where state is None if the
+    # search was exhausted or ran out of time.
+    workers = workers or multiprocessing.cpu_count()
+    (nodes, frontier) = load_frontier(checkpoint, k)
+    deepest = 0
+    deadline = None
+    if max_seconds is not None:
+        deadline = time.time() + max_seconds
+    saved = time.time()
+    done = Queue.Queue()
+    in_flight = []
+    # Workers map the capture's files themselves, so they share its pages.
+    pool = multiprocessing.Pool(workers, _start_worker, (k, capture))
+    try:
+        while frontier or in_flight:
+            if deadline is not None and time.time() > deadline:
+                break
+            # Keep every worker busy with a task queued behind it.
+            while frontier and len(in_flight) < 2 * workers:
+                path = frontier.pop()
+                in_flight.append(path)
+                pool.apply_async(_explore, ((path, chunk),),
+                                 callback=done.put)
+            (path, state, rest, explored, depth, rounds, error) = done.get()
+            if error is not None:
+                raise RuntimeError("worker failed below %s: %s"
+                                   % (path, error))
+            in_flight.remove(path)
+            nodes += explored
+            deepest = max(deepest, depth)
+            if state is not None:
+                if checkpoint is not None and os.path.exists(checkpoint):
+                    os.remove(checkpoint)
+                return (state, rounds, nodes, deepest)
+            frontier.extend(rest)
+            if (checkpoint is not None and
+                    time.time() - saved > checkpoint_seconds):
+                save_frontier(checkpoint, k, nodes, frontier + in_flight)
+                saved = time.time()
+    finally:
+        pool.terminate()
+        pool.join()
+    if checkpoint is not None:
+        if frontier or in_flight:
+            save_frontier(checkpoint, k, nodes, frontier + in_flight)
+        elif os.path.exists(checkpoint):
+            os.remove(checkpoint)
+    return (None, 0, nodes, deepest)
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [k ...]")
+    parser.add_option("--max-nodes", type="int",
+                      help="Give up on a key after this many search nodes.")
+    parser.add_option("--max-seconds", type="float", default=60.0,
+                      help="Give up on a key after this many seconds "
+                      "(default %default; 0 for no limit).")
+    parser.add_option("--parallel", action="store_true", default=False,
+                      help="Search with a pool of worker processes.")
+    parser.add_option("--workers", type="int",
+                      help="Worker processes; defaults to the CPU count.")
+    parser.add_option("--checkpoint-dir",
+                      help="Save each parallel search's frontier here, and "
+                      "resume from it.")
+    (options, args) = parser.parse_args(argv[1:])
+    ks = [int(k) for k in args] or [8]
+    max_seconds = options.max_seconds or None
+    if options.checkpoint_dir and not os.path.isdir(options.checkpoint_dir):
+        os.makedirs(options.checkpoint_dir)
+
+    failed = 0
+    for k in ks:
+        capture = rc4_data.Capture.open(k)
+        start = time.time()
+        if options.parallel:
+            checkpoint = None
+            if options.checkpoint_dir:
+                checkpoint = os.path.join(options.checkpoint_dir,
+                                          'frontier%d.json' % k)
+            (state, rounds, nodes, deepest) = solve_parallel(
+                k, capture, options.workers, max_seconds, checkpoint)
+        else:
+            solver = Rc4StateSolver(k, capture, options.max_nodes,
+                                    max_seconds)
+            state = solver.solve()
+            (nodes, deepest, rounds) = (solver.nodes, solver.deepest,
+                                        solver.rounds)
+        seconds = time.time() - start
+        if state is None:
+            failed += 1
+            print "k=%d: not solved (%d nodes, %d rounds deep, %.2fs)" % (
+                k, nodes, deepest, seconds)
+        else:
+            print "k=%d: solved in %d rounds (%d nodes, %.2fs)" % (
+                k, rounds, nodes, seconds)
+            print "    S0 = " + str(state)
+        capture.close()
+    return failed
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))